@@ -0,0 +1,187 @@
+import argparse, contextlib, io, json, math, platform, statistics, sys, unittest
+from time import perf_counter
+
+import sympy
+from sympy.core.cache import clear_cache
+
+try:
+    from . import evaluation, expression_utilities, preview
+    from .result_cache import result_cache_disabled
+except ImportError:
+    import evaluation, expression_utilities, preview
+    from result_cache import result_cache_disabled
+
+# -------- Benchmark of evaluation_function
+#
+# The benchmark corpus is harvested from the cases in evaluation_tests.py,
+# including the syntax variations generated by assertEqual_input_variations,
+# by running the tests with a wrapper that records every call of
+# evaluation_function. Each case is timed with cold caches (sympy's cache and
+# the caches in this package are cleared before the call) and with warm
+# caches (the same call repeated), and the results are summarised per case
+# and per comparison mode. The persistent result cache (see result_cache.py)
+# is disabled while the benchmark runs, so that every call is graded. Run with
+#
+#     python -m app.benchmark [--repeat N] [--comparison MODE] [--output FILE]
+#
+# Use --save-corpus and --corpus to benchmark different releases on the same cases.
+
+def harvest_corpus():
+    '''
+    Output:
+        List of distinct cases, each a dictionary with the keys
+        `response`, `answer` and `params`, used in TestEvaluationFunction
+    '''
+    # evaluation_tests prints when it is imported and the tests might print too
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            from . import evaluation_tests
+        except ImportError:
+            import evaluation_tests
+    corpus = {}
+    original_evaluation_function = evaluation_tests.evaluation_function
+
+    def recording_evaluation_function(response, answer, params):
+        case = {"response": response, "answer": answer, "params": params}
+        key = json.dumps(case, sort_keys=True, default=str)
+        if key not in corpus.keys():
+            corpus[key] = json.loads(key)
+        return original_evaluation_function(response, answer, params)
+
+    evaluation_tests.evaluation_function = recording_evaluation_function
+    try:
+        suite = unittest.defaultTestLoader.loadTestsFromTestCase(evaluation_tests.TestEvaluationFunction)
+        with contextlib.redirect_stdout(io.StringIO()):
+            unittest.TextTestRunner(stream=io.StringIO(), verbosity=0).run(suite)
+    finally:
+        evaluation_tests.evaluation_function = original_evaluation_function
+    return list(corpus.values())
+
+def clear_caches():
+    '''
+    Clears sympy's cache and all functools caches in the evaluation modules.
+    '''
+    clear_cache()
+    for module in (evaluation, expression_utilities, preview):
+        for obj in vars(module).values():
+            if callable(getattr(obj, "cache_clear", None)):
+                obj.cache_clear()
+
+def time_call(case):
+    start = perf_counter()
+    try:
+        evaluation.evaluation_function(case["response"], case["answer"], case["params"])
+        error = None
+    except Exception as e:
+        error = repr(e)
+    return perf_counter()-start, error
+
+def percentile(values, fraction):
+    '''
+    Returns the value below which the given fraction of the values lie
+    (nearest-rank method).
+    '''
+    ordered = sorted(values)
+    index = max(0, min(len(ordered)-1, math.ceil(fraction*len(ordered))-1))
+    return ordered[index]
+
+def latency_statistics(values):
+    return {
+        "count": len(values),
+        "mean": statistics.mean(values),
+        "median": statistics.median(values),
+        "p90": percentile(values, 0.9),
+        "p99": percentile(values, 0.99),
+        "min": min(values),
+        "max": max(values),
+    }
+
+def benchmark_case(case, repeat=5):
+    '''
+    Input:
+        case   : dictionary with the keys `response`, `answer` and `params`
+        repeat : number of timed calls with warm caches
+    Output:
+        Dictionary with the case, the duration (in seconds) of the call
+        with cold caches, statistics for the calls with warm caches and the
+        exception raised (if any)
+    '''
+    clear_caches()
+    cold, error = time_call(case)
+    warm = [time_call(case)[0] for _ in range(repeat)]
+    return {
+        **case,
+        "comparison": case["params"].get("comparison", "expression"),
+        "error": error,
+        "cold": cold,
+        "warm": latency_statistics(warm),
+    }
+
+def summarise(results):
+    '''
+    Returns latency and throughput statistics for all results and for the
+    results of each comparison mode.
+    '''
+    groups = {"all": results}
+    for result in results:
+        groups.setdefault(result["comparison"], []).append(result)
+    summary = {}
+    for (name, group) in groups.items():
+        warm_means = [result["warm"]["mean"] for result in group]
+        summary[name] = {
+            "cases": len(group),
+            "errors": sum(1 for result in group if result["error"] is not None),
+            "cold": latency_statistics([result["cold"] for result in group]),
+            "warm": latency_statistics(warm_means),
+            "warm_throughput": len(warm_means)/sum(warm_means) if sum(warm_means) > 0 else None,
+        }
+    return summary
+
+def run_benchmark(corpus, repeat=5, comparison=None):
+    if comparison is not None:
+        corpus = [case for case in corpus if case["params"].get("comparison", "expression") == comparison]
+    # Results from the persistent cache would make the calls cache lookups
+    with result_cache_disabled():
+        results = [benchmark_case(case, repeat) for case in corpus]
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "sympy": sympy.__version__,
+            "platform": platform.platform(),
+        },
+        "repeat": repeat,
+        "summary": summarise(results) if len(results) > 0 else {},
+        "cases": results,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark evaluation_function on the cases from evaluation_tests.py.")
+    parser.add_argument("--corpus", help="read the cases from this JSON file instead of harvesting them from the tests")
+    parser.add_argument("--save-corpus", help="write the cases to this JSON file")
+    parser.add_argument("--repeat", type=int, default=5, help="number of calls with warm caches for each case")
+    parser.add_argument("--comparison", help="only benchmark cases with this comparison mode")
+    parser.add_argument("--output", help="write the results to this file instead of stdout")
+    parser.add_argument("--summary-only", action="store_true", help="leave out the results for each case")
+    args = parser.parse_args(argv)
+
+    if args.corpus is not None:
+        with open(args.corpus) as file:
+            corpus = json.load(file)
+    else:
+        corpus = harvest_corpus()
+    if args.save_corpus is not None:
+        with open(args.save_corpus, "w") as file:
+            json.dump(corpus, file, indent=2)
+
+    results = run_benchmark(corpus, repeat=args.repeat, comparison=args.comparison)
+    if args.summary_only:
+        del results["cases"]
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import math, re
+
+# -------- Expression complexity guard
+#
+# Some responses, e.g. deeply nested parentheses, `10**10**10` or sums with
+# thousands of terms, make parsing, expansion or simplification with sympy
+# use a lot of time and memory. Responses are checked against the limits
+# below before they are parsed, so that such responses get feedback quickly
+# instead of occupying the process. The limits can be changed with the
+# `complexity_limits` parameter, e.g. {"max_depth": 100}, and a limit is
+# turned off by setting it to None.
+
+default_complexity_limits = {
+    "max_length": 2000,   # number of characters
+    "max_depth": 50,      # nesting depth of brackets
+    "max_terms": 500,     # number of terms (+ and - signs and commas)
+    "max_exponent": 1000, # absolute value of exponents that only contain numbers
+}
+
+complexity_feedback_responses = {
+    "max_length": lambda value, limit: f"The response is too long to be checked ({value} characters, the limit is {limit}).",
+    "max_depth": lambda value, limit: f"The response has too many nested brackets to be checked ({value} levels, the limit is {limit}).",
+    "max_terms": lambda value, limit: f"The response has too many terms to be checked ({value} terms, the limit is {limit}).",
+    "max_exponent": lambda value, limit: f"The response contains an exponent that is too large to be checked (the limit is {limit}).",
+}
+
+_token_re = re.compile(
+    r"(?P<number>(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?)"
+    r"|(?P<name>[^\W\d]\w*)"
+    r"|(?P<op>\*\*|[-+*/^(),\[\]{}])"
+    r"|(?P<space>\s+)"
+    r"|(?P<other>.)",
+    re.DOTALL
+)
+
+_opening_brackets = ("(", "[", "{")
+_closing_brackets = (")", "]", "}")
+_power_operators = ("**", "^")
+
+class ExpressionTooComplex(Exception):
+    def __init__(self, measure, value, limit):
+        super().__init__(complexity_feedback_responses[measure](value, limit))
+        self.measure = measure
+        self.value = value
+        self.limit = limit
+
+def scan(expr):
+    return [(match.lastgroup, match.group()) for match in _token_re.finditer(expr) if match.lastgroup != "space"]
+
+def numeric_exponent(tokens, index):
+    '''
+    Input:
+        tokens : tokens from scan
+        index  : index of the first token of the operand of a power
+    Output:
+        Pair with the absolute value of the operand, if it is a number or a
+        power of numbers (possibly with a sign and in parentheses), and the
+        index after the operand. The value is None for other operands and
+        inf if it is too large to be computed.
+    '''
+    while index < len(tokens) and tokens[index] in (("op", "-"), ("op", "+")):
+        index += 1
+    if index >= len(tokens):
+        return None, index
+    kind, text = tokens[index]
+    if (kind, text) == ("op", "("):
+        value, end = numeric_exponent(tokens, index+1)
+        if value is not None and end < len(tokens) and tokens[end] == ("op", ")"):
+            return value, end+1
+        return None, index
+    if kind != "number":
+        return None, index
+    value = abs(float(text))
+    index += 1
+    if index < len(tokens) and tokens[index][0] == "op" and tokens[index][1] in _power_operators:
+        exponent, end = numeric_exponent(tokens, index+1)
+        if exponent is None:
+            return None, index
+        try:
+            value = value**exponent
+        except OverflowError:
+            value = math.inf
+        index = end
+    return value, index
+
+def expression_complexity(expr):
+    '''
+    Input:
+        expr : string with an expression
+    Output:
+        Dictionary with the length, the nesting depth of brackets, the number
+        of terms and the largest absolute value of an exponent that only
+        contains numbers (0 if there are no such exponents), with the same
+        keys as the limits.
+    '''
+    tokens = scan(expr)
+    depth = 0
+    max_depth = 0
+    terms = 1
+    max_exponent = 0
+    for (index, (kind, text)) in enumerate(tokens):
+        if kind != "op":
+            continue
+        if text in _opening_brackets:
+            depth += 1
+            max_depth = max(depth, max_depth)
+        elif text in _closing_brackets:
+            depth = max(depth-1, 0)
+        elif text in ("+", "-", ","):
+            terms += 1
+        elif text in _power_operators:
+            exponent, _ = numeric_exponent(tokens, index+1)
+            if exponent is not None:
+                max_exponent = max(exponent, max_exponent)
+    return {"max_length": len(expr), "max_depth": max_depth, "max_terms": terms, "max_exponent": max_exponent}
+
+def complexity_limits(params):
+    limits = dict(default_complexity_limits)
+    limits.update(params.get("complexity_limits", {}))
+    return limits
+
+def check_expression_length(expr, params):
+    '''
+    Raises ExpressionTooComplex if expr is longer than the `max_length`
+    limit. Used before the response is preprocessed, since preprocessing
+    very long responses is slow.
+    '''
+    limit = complexity_limits(params)["max_length"]
+    if limit is not None and len(expr) > limit:
+        raise ExpressionTooComplex("max_length", len(expr), limit)
+
+def check_expression_complexity(expr, params):
+    '''
+    Input:
+        expr   : string with an expression
+        params : evaluation function parameter dictionary
+    Raises ExpressionTooComplex, with feedback for the first limit that is
+    exceeded as message, if the expression exceeds any of the limits.
+    '''
+    limits = complexity_limits(params)
+    if limits["max_length"] is not None and len(expr) > limits["max_length"]:
+        # Long expressions are not scanned at all
+        raise ExpressionTooComplex("max_length", len(expr), limits["max_length"])
+    complexity = expression_complexity(expr)
+    for (measure, limit) in limits.items():
+        if limit is not None and complexity.get(measure, 0) > limit:
+            raise ExpressionTooComplex(measure, complexity[measure], limit)
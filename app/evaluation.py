@@ -1,23 +1,64 @@
 from sympy.parsing.sympy_parser import parse_expr
-from sympy import simplify, latex, Matrix, Symbol, Integer, Add, pi, posify, prod
-import sys, re
+from sympy import simplify, latex, Matrix, Symbol, Integer, Add, Mul, pi, posify, prod
+import contextvars, math, sys, re
 
 try:
     from .static_unit_conversion_arrays import convert_short_forms, convert_to_SI_base_units, convert_to_SI_base_units_short_form, convert_SI_base_units_to_dimensions, convert_SI_base_units_to_dimensions_short_form, names_of_prefixes_units_and_dimensions, convert_alternative_names_to_standard
-    from .expression_utilities import preprocess_expression, parse_expression, create_sympy_parsing_params, substitute
+    from .expression_utilities import preprocess_expression, parse_expression, create_sympy_parsing_params, create_order_preserving_parsing_params, substitute
     from .preview import preview_function
+    from .timing import StageTimer, timings_enabled, timings_requested, record_timings
+    from .profiling import slow_call_capture
+    from .result_cache import get_result_cache, result_cache_key, result_cacheable
+    from .complexity import check_expression_length, check_expression_complexity, ExpressionTooComplex
+    from .memory import trim_caches_between_calls, memory_report
+    from .metrics import count, observe_timings, metrics_enabled
 except ImportError:
     from static_unit_conversion_arrays import convert_short_forms, convert_to_SI_base_units, convert_to_SI_base_units_short_form, convert_SI_base_units_to_dimensions, convert_SI_base_units_to_dimensions_short_form, names_of_prefixes_units_and_dimensions, convert_alternative_names_to_standard
-    from expression_utilities import preprocess_expression, parse_expression, create_sympy_parsing_params, substitute
+    from expression_utilities import preprocess_expression, parse_expression, create_sympy_parsing_params, create_order_preserving_parsing_params, substitute
     from preview import preview_function
+    from timing import StageTimer, timings_enabled, timings_requested, record_timings
+    from profiling import slow_call_capture
+    from result_cache import get_result_cache, result_cache_key, result_cacheable
+    from complexity import check_expression_length, check_expression_complexity, ExpressionTooComplex
+    from memory import trim_caches_between_calls, memory_report
+    from metrics import count, observe_timings, metrics_enabled
+
+# Feedback given with the `custom_feedback` parameter replaces the default
+# feedback below for the current call only, it is stored in a context
+# variable so that concurrent calls (in other threads) are not affected
+custom_feedback_context = contextvars.ContextVar("custom_feedback", default={})
+
+def wrap_feedback_function(output):
+    # Wraps a string in a function that takes an arbitrary number of arguments
+    def wrapped_function(*args):
+        return output
+    return wrapped_function
+
+class FeedbackResponses(dict):
+    '''
+    Dictionary of default feedback, entries that are given in the custom
+    feedback of the current call are replaced by the custom feedback.
+    '''
+
+    def __getitem__(self, key):
+        custom_feedback = custom_feedback_context.get()
+        if key in custom_feedback.keys() and key in self.keys():
+            default = super().__getitem__(key)
+            if isinstance(default, str):
+                return custom_feedback[key]
+            elif callable(default):
+                return wrap_feedback_function(custom_feedback[key])
+            else:
+                raise Exception("Cannot handle given costum feedback for "+key)
+        return super().__getitem__(key)
 
-parsing_feedback_responses = {
+parsing_feedback_responses = FeedbackResponses({
     "PARSE_ERROR_WARNING": lambda x: f"`{x}` could not be parsed as a valid mathematical expression. Ensure that correct notation is used, that the expression is unambiguous and that all parentheses are closed.",
     "PER_FOR_DIVISION": "Note that 'per' was interpreted as '/'. This can cause ambiguities. It is recommended to use parentheses to make your entry unambiguous.",
     "STRICT_SYNTAX_EXPONENTIATION": "Note that `^` cannot be used to denote exponentiation, use `**` instead.",
     "QUANTITIES_NOT_WRITTEN_CORRECTLY": "List of quantities not written correctly.",
     "SUBSTITUTIONS_NOT_WRITTEN_CORRECTLY": "List of substitutions not written correctly.",
-}
+})
 
 def feedback_not_dimensionless(groups):
     groups = list(groups)
@@ -32,7 +73,7 @@ def convert_to_latex(expr):
     else:
         return "$"+latex(expr)+"$"
 
-buckingham_pi_feedback_responses = {
+buckingham_pi_feedback_responses = FeedbackResponses({
     "VALID_CANDIDATE_SET": "",
     "NOT_DIMENSIONLESS": feedback_not_dimensionless,
     "MORE_GROUPS_THAN_REFERENCE_SET": "Response has more groups than necessary.",
@@ -40,24 +81,126 @@ buckingham_pi_feedback_responses = {
     "TOO_FEW_INDEPENDENT_GROUPS": lambda name, r, n: f"{name} contains too few independent groups. It has {r} independent group(s) and needs at least {n} independent groups.",
     "UNKNOWN_SYMBOL": lambda symbols: "Unknown symbol(s): "+", ".join([convert_to_latex(s) for s in symbols])+".",
     "SUM_WITH_INDEPENDENT_TERMS": lambda s: f"Sum in {convert_to_latex(s)} contains more independent terms that there are groups in total. Group expressions should ideally be written as a comma-separated list where each item is an entry of the form `q_1**c_1*q_2**c_2*...*q_n**c_n`."
-}
+})
 
 feedback_responses_list = [parsing_feedback_responses, buckingham_pi_feedback_responses]
 
 
+def get_exponents(expression, symbols):
+    exponents = []
+    for symbol in symbols:
+        exponent = expression.as_coeff_exponent(symbol)[1]
+        if exponent == 0:
+            exponent = -expression.subs(symbol, 1/symbol).as_coeff_exponent(symbol)[1]
+        exponents.append(exponent)
+    return exponents
+
+
 def get_exponent_matrix(expressions, symbols):
     exponents_list = []
     for expression in expressions:
-        exponents = []
-        for symbol in symbols:
-            exponent = expression.as_coeff_exponent(symbol)[1]
-            if exponent == 0:
-                exponent = -expression.subs(symbol, 1/symbol).as_coeff_exponent(symbol)[1]
-            exponents.append(exponent)
-        exponents_list.append(exponents)
+        exponents_list.append(get_exponents(expression, symbols))
     return Matrix(exponents_list)
 
 
+def power_product_exponents(expression):
+    '''
+    Returns a dictionary with the exponent of each symbol in expression if expression
+    is a power product, i.e. on the form `a*q_1**c_1*q_2**c_2*...*q_n**c_n` where `a`
+    is a constant and `c_1, c_2, ..., c_n` are numbers. Otherwise None is returned.
+    '''
+    exponents = {}
+    for factor in Mul.make_args(expression):
+        if factor.is_Symbol:
+            exponents[factor] = exponents.get(factor, 0)+1
+        elif factor.is_Pow and factor.base.is_Symbol and factor.exp.is_Number:
+            exponents[factor.base] = exponents.get(factor.base, 0)+factor.exp
+        elif len(factor.free_symbols) > 0:
+            return None
+    return exponents
+
+
+def split_into_power_products(expression):
+    '''
+    Returns a list of the power products in expression. Expressions that are not
+    already power products are simplified and expanded first, and if the result
+    is a sum each term is returned as a separate power product.
+    '''
+    if power_product_exponents(expression) is None:
+        expression = expression.simplify()
+        expression = expression.expand(power_base=True, force=True)
+    if isinstance(expression, Add):
+        return list(expression.args)
+    return [expression]
+
+
+class PowerProductGroups:
+    '''
+    Representation of a list of groups used by the buckinghamPi comparison.
+    Each group is parsed once and split into power products. The exponents of each
+    power product are computed once and then shared by the symbol collection, the
+    validity analysis and the LaTeX output. Exponent matrices and their ranks are
+    cached per list of symbols.
+    '''
+
+    def __init__(self, groups, original_number_of_groups=None):
+        self.power_products = []
+        for group in groups:
+            self.power_products += split_into_power_products(group)
+        if original_number_of_groups is None:
+            original_number_of_groups = len(groups)
+        self.original_number_of_groups = original_number_of_groups
+        self.symbols = set()
+        for power_product in self.power_products:
+            self.symbols = self.symbols.union(power_product.free_symbols)
+        self._exponents = {}
+        self._matrices = {}
+        self._ranks = {}
+
+    @classmethod
+    def from_strings(cls, strings, parsing_params):
+        return cls([parse_expression(string, parsing_params) for string in strings])
+
+    def __len__(self):
+        return len(self.power_products)
+
+    def __iter__(self):
+        return iter(self.power_products)
+
+    def distinct(self):
+        '''
+        Returns groups with duplicate power products removed. The cached exponents are shared.
+        '''
+        groups = PowerProductGroups([], self.original_number_of_groups)
+        groups.power_products = list(dict.fromkeys(self.power_products))
+        groups.symbols = self.symbols
+        groups._exponents = self._exponents
+        return groups
+
+    def exponents(self, power_product, symbols):
+        if power_product not in self._exponents.keys():
+            self._exponents[power_product] = power_product_exponents(power_product)
+        exponents = self._exponents[power_product]
+        if exponents is None:
+            return get_exponents(power_product, symbols)
+        return [exponents.get(symbol, 0) for symbol in symbols]
+
+    def exponent_matrix(self, symbols):
+        symbols = tuple(symbols)
+        if symbols not in self._matrices.keys():
+            self._matrices[symbols] = Matrix([self.exponents(power_product, symbols) for power_product in self.power_products])
+        return self._matrices[symbols]
+
+    def rank(self, symbols):
+        symbols = tuple(symbols)
+        if symbols not in self._ranks.keys():
+            self._ranks[symbols] = self.exponent_matrix(symbols).rank()
+        return self._ranks[symbols]
+
+    def latex(self):
+        return [latex(power_product) for power_product in self.power_products]
+
+
 def string_to_expressions(string):
     beta = Symbol("beta")
     gamma = Symbol("gamma")
@@ -93,83 +236,376 @@ def create_power_product(exponents, symbols):
     return prod([s**i for (s, i) in zip(symbols, exponents)])
 
 
-def determine_validity(reference_set, reference_symbols, reference_original_number_of_groups, candidate_set, candidate_symbols, candidate_original_number_of_groups):
+class BuckinghamReference:
     '''
-    Analyses if the given candidate set satisfies the Buckingham Pi theorem assuming that the given reference set does.
+    Reference set of groups that is assumed to satisfy the Buckingham Pi theorem.
+    The exponent matrix of the reference set, a basis for its row space (in reduced
+    row echelon form) and its rank are computed once, so that validating a candidate
+    set only requires work on the candidate side. This is useful when many candidate
+    sets are validated against the same reference set.
     '''
-    symbols = set(reference_symbols).union(set(candidate_symbols))
-    R = get_exponent_matrix(reference_set, symbols)
-    C = get_exponent_matrix(candidate_set, symbols)
-    D = R.col_join(C)
-    feedback = []
-    more_groups_than_reference_set = reference_original_number_of_groups < candidate_original_number_of_groups
-    candidate_groups_independent = C.rank() == candidate_original_number_of_groups
-    rank_R_equal_to_rank_D = R.rank() == D.rank()
-    rank_C_equal_to_rank_D = C.rank() == D.rank()
-    if candidate_symbols.issubset(reference_symbols):
-        valid = not more_groups_than_reference_set
-        if more_groups_than_reference_set:
-            feedback.append(buckingham_pi_feedback_responses["MORE_GROUPS_THAN_REFERENCE_SET"])
-        valid = valid and candidate_groups_independent
-        if not candidate_groups_independent:
-            feedback.append(buckingham_pi_feedback_responses["CANDIDATE_GROUPS_NOT_INDEPENDENT"](C.rank(), len(candidate_set)))
-        if rank_R_equal_to_rank_D:
-            if rank_C_equal_to_rank_D:
-                feedback.append(buckingham_pi_feedback_responses["VALID_CANDIDATE_SET"])
+
+    def __init__(self, reference_set, reference_symbols=None, reference_original_number_of_groups=None):
+        if not isinstance(reference_set, PowerProductGroups):
+            reference_set = PowerProductGroups(list(reference_set)).distinct()
+        if reference_symbols is None:
+            reference_symbols = reference_set.symbols
+        if reference_original_number_of_groups is None:
+            reference_original_number_of_groups = reference_set.original_number_of_groups
+        self.reference_set = reference_set
+        self.reference_symbols = set(reference_symbols)
+        self.reference_original_number_of_groups = reference_original_number_of_groups
+        self.symbols = sorted(self.reference_symbols, key=str)
+        self.matrix = reference_set.exponent_matrix(self.symbols)
+        self.rank = reference_set.rank(self.symbols)
+        if self.rank > 0:
+            rref, pivots = self.matrix.rref()
+            self.basis = [(rref.row(k), pivot) for k, pivot in enumerate(pivots)]
+        else:
+            self.basis = []
+
+    def residual(self, exponents):
+        '''
+        Returns the part of the row vector exponents that is not in the row space of the
+        reference matrix, this is zero if and only if the corresponding power product can
+        be written as a product of powers of the groups in the reference set.
+        '''
+        for (basis_row, pivot) in self.basis:
+            if exponents[pivot] != 0:
+                exponents = exponents-exponents[pivot]*basis_row
+        return exponents
+
+    def validate(self, candidate_set, candidate_symbols=None, candidate_original_number_of_groups=None):
+        '''
+        Analyses if the given candidate set satisfies the Buckingham Pi theorem.
+        Returns the same result as `determine_validity` would for the reference set.
+        '''
+        if not isinstance(candidate_set, PowerProductGroups):
+            candidate_set = PowerProductGroups(list(candidate_set)).distinct()
+        if candidate_symbols is None:
+            candidate_symbols = candidate_set.symbols
+        if candidate_original_number_of_groups is None:
+            candidate_original_number_of_groups = candidate_set.original_number_of_groups
+        candidate_symbols = set(candidate_symbols)
+        feedback = []
+        if candidate_symbols.issubset(self.reference_symbols):
+            C = candidate_set.exponent_matrix(self.symbols)
+            rank_C = candidate_set.rank(self.symbols)
+            residuals = [self.residual(C.row(i)) for i in range(C.rows)]
+            if len(residuals) > 0:
+                rank_D = self.rank+Matrix.vstack(*residuals).rank()
+            else:
+                rank_D = self.rank
+            more_groups_than_reference_set = self.reference_original_number_of_groups < candidate_original_number_of_groups
+            candidate_groups_independent = rank_C == candidate_original_number_of_groups
+            valid = not more_groups_than_reference_set
+            if more_groups_than_reference_set:
+                feedback.append(buckingham_pi_feedback_responses["MORE_GROUPS_THAN_REFERENCE_SET"])
+            valid = valid and candidate_groups_independent
+            if not candidate_groups_independent:
+                feedback.append(buckingham_pi_feedback_responses["CANDIDATE_GROUPS_NOT_INDEPENDENT"](rank_C, len(candidate_set)))
+            if self.rank == rank_D:
+                if rank_C == rank_D:
+                    feedback.append(buckingham_pi_feedback_responses["VALID_CANDIDATE_SET"])
+                else:
+                    valid = False
+                    feedback.append(buckingham_pi_feedback_responses["TOO_FEW_INDEPENDENT_GROUPS"]("Response", rank_C, rank_D))
             else:
                 valid = False
-                feedback.append(buckingham_pi_feedback_responses["TOO_FEW_INDEPENDENT_GROUPS"]("Response", C.rank(), D.rank()))
+                if len(candidate_set) == 1:
+                    dimensionless_groups = candidate_set
+                else:
+                    dimensionless_groups = set()
+                    for i, residual in enumerate(residuals):
+                        if not residual.is_zero_matrix:
+                            dimensionless_groups.add(create_power_product(C.row(i), self.symbols))
+                feedback.append(buckingham_pi_feedback_responses["NOT_DIMENSIONLESS"](dimensionless_groups))
         else:
+            feedback.append(buckingham_pi_feedback_responses["UNKNOWN_SYMBOL"](candidate_symbols.difference(self.reference_symbols)))
             valid = False
-            if len(candidate_set) == 1:
-                dimensionless_groups = candidate_set
+        feedback = [elem.strip() for elem in feedback if len(elem.strip()) > 0]
+        return valid, "<br>".join(feedback)
+
+    def validate_all(self, candidate_sets):
+        '''
+        Validates each candidate set in an iterable of candidate sets, yields the results in order.
+        '''
+        for candidate_set in candidate_sets:
+            yield self.validate(candidate_set)
+
+
+def determine_validity(reference_set, reference_symbols, reference_original_number_of_groups, candidate_set, candidate_symbols, candidate_original_number_of_groups):
+    '''
+    Analyses if the given candidate set satisfies the Buckingham Pi theorem assuming that the given reference set does.
+    The reference and candidate sets can be given either as PowerProductGroups or as collections of power products.
+    To validate several candidate sets against the same reference set use BuckinghamReference instead.
+    '''
+    reference = BuckinghamReference(reference_set, reference_symbols, reference_original_number_of_groups)
+    return reference.validate(candidate_set, candidate_symbols, candidate_original_number_of_groups)
+
+
+class DeferredValue:
+    '''
+    Value in a result dictionary that is computed by calling function(*args) when needed.
+    If function raises an exception and fallback is given the value is fallback() instead.
+    '''
+
+    def __init__(self, function, *args, fallback=None):
+        self.function = function
+        self.args = args
+        self.fallback = fallback
+        # The value is computed with the custom feedback of the call that created it
+        self.context = contextvars.copy_context()
+
+    def __call__(self):
+        try:
+            return self.context.run(self.function, *self.args)
+        except Exception:
+            if self.fallback is None:
+                raise
+            return self.context.run(self.fallback)
+
+
+class EvaluationResult(dict):
+    '''
+    Dictionary returned by evaluation_function when the `generate_response_latex`
+    parameter is set to `"lazy"`. Entries with deferred values are computed the first
+    time they are accessed, until then they are not stored in the dictionary (so they
+    are not included when the dictionary is iterated over or serialised).
+    '''
+
+    def __init__(self, result):
+        super().__init__()
+        self._deferred = {}
+        for (key, value) in result.items():
+            if isinstance(value, DeferredValue):
+                self._deferred[key] = value
             else:
-                dimensionless_groups = set()
-                for i in range(len(candidate_set)):
-                    exponents = C.row(i)
-                    Di = R.col_join(exponents)
-                    if R.rank() != Di.rank():
-                        dimensionless_groups.add(create_power_product(exponents, symbols))
-            feedback.append(buckingham_pi_feedback_responses["NOT_DIMENSIONLESS"](dimensionless_groups))
-    else:
-        feedback.append(buckingham_pi_feedback_responses["UNKNOWN_SYMBOL"](candidate_symbols.difference(reference_symbols)))
-        valid = False
-    feedback = [elem.strip() for elem in feedback if len(elem.strip()) > 0]
-    return valid, "<br>".join(feedback)
+                self[key] = value
+
+    def __missing__(self, key):
+        if key in self._deferred.keys():
+            value = self._deferred.pop(key)()
+            self[key] = value
+            return value
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return super().__contains__(key) or key in self._deferred.keys()
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+
+def per_is_input_symbol(parameters):
+    return "per" in sum([[x[0]]+x[1] for x in parameters.get("input_symbols", [])], [])
+
+def substitute_alternative_names(expression):
+    return substitute(expression+" ", convert_alternative_names_to_standard+[(" per ", "/")])[0:-1]
+
+# Whitespace that is removed from responses by canonical_response. Only
+# whitespace next to `/`, `**` and parentheses is removed, and only where the
+# neighbouring character is part of an operand, so that no operators are
+# joined (e.g. `/ /` is not turned into `//`). Since none of the unit
+# substitutions contain these characters, and the tokens of the expression
+# are the same, the response is substituted and parsed in the same way.
+canonical_response_whitespace = [
+    (re.compile(r"(?<=[\w)])\s*(\*\*|/)\s*(?=[\w(])"), r"\1"),
+    (re.compile(r"\(\s+"), "("),
+    (re.compile(r"\s+\)"), ")"),
+]
+
+def canonical_response(response, params):
+    '''
+    Input:
+        response : response as given to evaluation_function
+        params   : evaluation function parameter dictionary
+    Output:
+        The response after the same string substitutions as in
+        _evaluation_function and with whitespace that does not affect
+        parsing removed (and, if strict syntax is not used, `^` replaced by `**`).
+        Two responses with the same canonical response are graded the same
+        (except that feedback for responses that could not be parsed quotes
+        the response), so this is used in the key of the result cache.
+        Computing it costs a full pass of substitutions and preprocessing over
+        the response, so responses that are longer than the `max_length`
+        limit are returned unchanged.
+    '''
+    if not isinstance(response, str) or params.get("is_latex", False):
+        return response
+    parameters = {"strict_syntax": True}
+    parameters.update(params)
+    try:
+        check_expression_length(response.strip(), parameters)
+    except ExpressionTooComplex:
+        return response
+    if not per_is_input_symbol(parameters):
+        if " per " in response:
+            # The feedback depends on how the response was written
+            return response.strip()
+        response = substitute_alternative_names(response)
+    response = preprocess_expression([response.strip()], parameters)[0]
+    # Custom substitutions can contain any characters and responses that
+    # start with zeros are handled differently, so these are left as they are
+    if "substitutions" in parameters.keys() or "quantities" in parameters.keys() or response.startswith("0"):
+        return response
+    if not parameters["strict_syntax"]:
+        response = response.replace("^", "**")
+    for (pattern, replacement) in canonical_response_whitespace:
+        response = pattern.sub(replacement, response)
+    return response
+
+# _evaluation_function adds this key to results for responses that are
+# rejected, with the reason ("parse_error" or "too_complex") as value, and
+# evaluation_function removes it before the result is returned
+rejection_key = "_rejected"
+
+def parse_error_feedback(expression, remark):
+    separator = "" if len(remark) == 0 else "\n"
+    return {"is_correct": False, "feedback": parsing_feedback_responses["PARSE_ERROR_WARNING"](expression)+separator+remark}
+
+def parse_error_result(expression, remark):
+    return {**parse_error_feedback(expression, remark), rejection_key: "parse_error"}
+
+def too_complex_result(exception, generate_response_latex, remark):
+    '''
+    Returns the result for a response that is rejected by check_expression_complexity.
+    The response is not parsed, so its LaTeX is given in the same way as for a
+    response that cannot be parsed, with the feedback from the exception.
+    '''
+    separator = "" if len(remark) == 0 else "\n"
+    interp = response_latex_interpretation(generate_response_latex, lambda: {"is_correct": False, "feedback": str(exception)})
+    return {"is_correct": False, "feedback": str(exception)+separator+remark, **interp, rejection_key: "too_complex"}
+
+def rejection_reason(result):
+    '''
+    Removes the rejection marker from a result of _evaluation_function and
+    returns the reason the response was rejected, or None. Responses whose
+    LaTeX could not be computed (`response_latex` is the feedback for a
+    response that cannot be parsed) are parse errors.
+    '''
+    reason = result.pop(rejection_key, None)
+    if reason is None and isinstance(result.get("response_latex", None), dict):
+        reason = "parse_error"
+    return reason
+
+def long_response_result(response, params):
+    '''
+    Returns the result for a response that is longer than the `max_length`
+    limit, or None. LaTeX responses are checked by the preview function
+    instead, after the LaTeX is sanitised.
+    '''
+    if not isinstance(response, str) or params.get("is_latex", False):
+        return None
+    try:
+        check_expression_length(response.strip(), params)
+    except ExpressionTooComplex as e:
+        count("rejected_responses", measure=e.measure)
+        return too_complex_result(e, params.get("generate_response_latex", True), "")
+    return None
 
+def evaluation_outcome(result, rejection):
+    '''
+    Returns "correct", "incorrect" or the reason the response was rejected,
+    used as label of the evaluation metrics.
+    '''
+    if result.get("is_correct", False) is True:
+        return "correct"
+    if rejection is not None:
+        return rejection
+    return "incorrect"
 
 def evaluation_function(response, answer, params) -> dict:
     """
     Function that provides some basic dimensional analysis functionality.
     """
+    # Very long responses are rejected before anything else is done with
+    # them, in particular before the key for the result cache is computed
+    result = long_response_result(response, params)
+    if result is not None:
+        count("evaluations", comparison=params.get("comparison", "expression"), outcome=rejection_reason(result))
+        return result
+
+    # Results with timings are not cached since the timings would not be for the current call
+    cache = None
+    if result_cacheable(params) and not timings_requested(params):
+        cache = get_result_cache()
+    if cache is not None:
+        cache_key = result_cache_key(canonical_response(response, params), answer, params)
+        result = cache.get(cache_key)
+        count("result_cache_lookups", result="miss" if result is None else "hit")
+        if result is not None:
+            return result
+
+    trim_caches_between_calls()
+    capture = slow_call_capture("evaluation_function", response=response, answer=answer, params=params)
+    collect_metrics = metrics_enabled()
+    comparison = params.get("comparison", "expression")
+    timer = StageTimer(timings_enabled(params) or capture.enabled or collect_metrics)
+    # Custom feedback given by the task author replaces the default feedback during this call
+    custom_feedback = custom_feedback_context.set(params.get("custom_feedback", None) or {})
+    try:
+        with capture:
+            try:
+                result = _evaluation_function(response, answer, params, timer)
+            finally:
+                # Calls that fail are captured with the timings up to the failure
+                if timer.enabled:
+                    capture.timings = timer.result()
+    except Exception:
+        count("evaluations", comparison=comparison, outcome="error")
+        raise
+    finally:
+        custom_feedback_context.reset(custom_feedback)
+    rejection = rejection_reason(result)
+    if collect_metrics:
+        count("evaluations", comparison=comparison, outcome=evaluation_outcome(result, rejection))
+        observe_timings("evaluation_stage_duration_seconds", capture.timings, comparison=comparison)
+    if timings_enabled(params):
+        record_timings(capture.timings)
+    if timings_requested(params):
+        result["timings"] = capture.timings
+        result["memory"] = memory_report()
+    if any(isinstance(value, DeferredValue) for value in result.values()):
+        result = EvaluationResult(result)
+    # Feedback for rejected responses depends on how the response was written
+    elif cache is not None and rejection is None:
+        cache.put(cache_key, result)
+    return result
+
+
+def response_latex_interpretation(generate_response_latex, function, *args, fallback=None):
+    '''
+    Returns the interpretation of the response that is added to the result,
+    depending on the `generate_response_latex` parameter the LaTeX for the
+    response is computed immediately (true), deferred ("lazy") or skipped (false).
+    Deferred values are fallback() if computing the LaTeX fails.
+    '''
+    if generate_response_latex == "lazy":
+        return {"response_latex": DeferredValue(function, *args, fallback=fallback)}
+    elif generate_response_latex:
+        return {"response_latex": function(*args)}
+    return {}
+
 
-    # Utility function that wraps a string in a function that takes an
-    # arbitrary number of arguments
-    def wrap_feedback_function(output):
-        def wrapped_function(*args):
-            return output
-        return wrapped_function
-
-    # Take custom feedback string given by task author and
-    # replace the corresponding entries in the feedback response
-    # dictionaries, wrapping pure stings in a function that takes
-    # an arbitrary number of arguments when necessary
-    custom_feedback = params.get("custom_feedback", None)
-    if custom_feedback is not None:
-        for feedback_responses in feedback_responses_list:
-            for key in custom_feedback.keys():
-                if key in feedback_responses.keys():
-                    if isinstance(feedback_responses[key], str):
-                        feedback_responses[key] = custom_feedback[key]
-                    elif callable(feedback_responses[key]):
-                        feedback_responses[key] = wrap_feedback_function(custom_feedback[key])
-                    else:
-                        raise Exception("Cannot handle given costum feedback for "+key)
+def _evaluation_function(response, answer, params, timer) -> dict:
+    timer.start("other")
 
     # Uses the preview function to translate latex input to  a
     # sympy compatible representation
     if params.get("is_latex", False):
-        response = preview_function(response, params)["preview"]["sympy"]
+        timer.start("latex_to_sympy")
+        try:
+            response = preview_function(response, params)["preview"]["sympy"]
+        except ValueError as e:
+            # The preview function rejects responses that are too complex
+            if not isinstance(e.__cause__, ExpressionTooComplex):
+                raise
+            count("rejected_responses", measure=e.__cause__.measure)
+            return too_complex_result(e.__cause__, params.get("generate_response_latex", True), "")
+        timer.start("other")
 
     feedback = {}
     default_rtol = 1e-12
@@ -182,19 +618,21 @@ def evaluation_function(response, answer, params) -> dict:
         unsplittable_symbols = names_of_prefixes_units_and_dimensions
 
     # Set default parameters if not already set
-    parameters = {"comparison": "expression", "strict_syntax": True}
+    parameters = {"comparison": "expression", "strict_syntax": True, "generate_response_latex": True}
     parameters.update(params)
 
     # Check if `per` is ised for division and add relevant remark to
     # feedback if so
     remark = ""
-    if "per" not in sum([[x[0]]+x[1] for x in parameters.get("input_symbols", [])], []):
+    if not per_is_input_symbol(parameters):
         if (" per " in response):
             remark += parsing_feedback_responses["PER_FOR_DIVISION"]
         if (" per " in answer):
             raise Exception(parsing_feedback_responses["PER_FOR_DIVISION"])
-        answer = substitute(answer+" ", convert_alternative_names_to_standard+[(" per ", "/")])[0:-1]
-        response = substitute(response+" ", convert_alternative_names_to_standard+[(" per ", "/")])[0:-1]
+        timer.start("substitute")
+        answer = substitute_alternative_names(answer)
+        response = substitute_alternative_names(response)
+        timer.start("other")
 
     # Raise exceptions when answer or response is missing from input
     if not isinstance(answer, str):
@@ -210,7 +648,9 @@ def evaluation_function(response, answer, params) -> dict:
         return {"is_correct": False, "feedback": "No response submitted."}
 
     # Preprocess answer and response to prepare for parsing by sympy
+    timer.start("preprocess_expression")
     answer, response = preprocess_expression([answer, response], parameters)
+    timer.start("other")
     parsing_params = create_sympy_parsing_params(parameters, unsplittable_symbols=unsplittable_symbols)
 
     # Remark on syntax if necessary
@@ -221,51 +661,36 @@ def evaluation_function(response, answer, params) -> dict:
         if "^" in answer:
             raise Exception(parsing_feedback_responses["STRICT_SYNTAX_EXPONENTIATION"])
 
+    # Responses that would be too expensive to parse and compare are rejected,
+    # the response is checked in the same form as in the preview function
+    try:
+        check_expression_complexity(response, parameters)
+    except ExpressionTooComplex as e:
+        count("rejected_responses", measure=e.measure)
+        return too_complex_result(e, parameters["generate_response_latex"], remark)
+
     # Perform buckinghamPi comparison
     if parameters["comparison"] == "buckinghamPi":
         # Parse expressions for groups in response and answer
-        response_strings = response.split(',')
-        response_number_of_groups = len(response_strings)
-        response_original_number_of_groups = len(response_strings)
-        response_groups = []
-        separator = "" if len(remark) == 0 else "\n"
-        for res in response_strings:
-            try:
-                expr = parse_expression(res, parsing_params).simplify()
-                expr = expr.expand(power_base=True, force=True)
-            except Exception:
-                separator = "" if len(remark) == 0 else "\n"
-                return {"is_correct": False, "feedback": parsing_feedback_responses["PARSE_ERROR_WARNING"](response)+separator+remark}
-            if isinstance(expr, Add):
-                response_groups += list(expr.args)
-                response_number_of_groups += len(list(expr.args))
-            else:
-                response_groups.append(expr)
-                response_number_of_groups += 1
-        response_latex = [latex(expr) for expr in response_groups]
+        timer.start("parse_expression")
+        try:
+            response_groups = PowerProductGroups.from_strings(response.split(','), parsing_params)
+        except Exception:
+            return parse_error_result(response, remark)
 
-        interp = {"response_latex": ", ".join(response_latex)}
+        timer.start("expression_to_latex")
+        interp = response_latex_interpretation(parameters["generate_response_latex"], lambda groups: ", ".join(groups.latex()), response_groups)
+        timer.start("parse_expression")
 
         if answer == "-":
             answer_strings = []
         else:
             answer_strings = answer.split(',')
-        answer_groups = []
-        answer_number_of_groups = 0
-        answer_original_number_of_groups = 0
-        for ans in answer_strings:
-            try:
-                expr = parse_expression(ans, parsing_params).simplify()
-                expr = expr.expand(power_base=True, force=True)
-            except Exception as e:
-                raise Exception(parsing_feedback_responses["PARSE_ERROR_WARNING"]("The answer")) from e
-            if isinstance(expr, Add):
-                answer_groups += list(expr.args)
-                answer_number_of_groups += len(list(expr.args))
-            else:
-                answer_groups.append(expr)
-                answer_number_of_groups += 1
-            answer_original_number_of_groups += 1
+        try:
+            answer_groups = PowerProductGroups.from_strings(answer_strings, parsing_params)
+        except Exception as e:
+            raise Exception(parsing_feedback_responses["PARSE_ERROR_WARNING"]("The answer")) from e
+        timer.start("comparison")
 
         remark = ""
 
@@ -294,7 +719,7 @@ def evaluation_function(response, answer, params) -> dict:
             number_of_groups = len(quantities)-quantity_matrix.rank()
 
             # If answer groups are not given, generate a valid set of groups to use as answer
-            if answer_groups == []:
+            if len(answer_groups) == 0:
                 # Compute answer groups from defined quantities
                 nullspace_basis = quantity_matrix.T.nullspace()
                 for basis_vector in nullspace_basis:
@@ -305,14 +730,14 @@ def evaluation_function(response, answer, params) -> dict:
                     if multiplier != 1:
                         for i in range(0, basis_vector.rows):
                             basis_vector[i, 0] = round(basis_vector[i, 0]*multiplier)
-                answer_groups = [1]*number_of_groups
-                for i in range(0, len(answer_groups)):
+                generated_groups = [1]*number_of_groups
+                for i in range(0, len(generated_groups)):
                     for j in range(0, len(quantities)):
-                        answer_groups[i] *= quantities[j][0]**nullspace_basis[i][j]
+                        generated_groups[i] *= quantities[j][0]**nullspace_basis[i][j]
+                answer_groups = PowerProductGroups(generated_groups)
 
             if answer == "-":
-                answer_number_of_groups = number_of_groups
-                answer_original_number_of_groups = number_of_groups
+                answer_groups.original_number_of_groups = number_of_groups
 
             # Analyse dimensions of answers and responses
             answer_dimensions = []
@@ -325,40 +750,32 @@ def evaluation_function(response, answer, params) -> dict:
             # Check that answers are dimensionless
             for k, dimension in enumerate(answer_dimensions):
                 if not dimension.is_constant():
-                    raise Exception(buckingham_pi_feedback_responses["NOT_DIMENSIONLESS"](answer_groups[k]))
+                    raise Exception(buckingham_pi_feedback_responses["NOT_DIMENSIONLESS"](answer_groups.power_products[k]))
 
             # Check that there is a sufficient number of independent groups in the answer
-            answer_matrix = get_exponent_matrix(answer_groups, answer_symbols)
-            if answer_matrix.rank() < number_of_groups:
-                raise Exception(buckingham_pi_feedback_responses["TOO_FEW_INDEPENDENT_GROUPS"]("Answer", answer_matrix.rank(), number_of_groups))
+            answer_rank = answer_groups.rank(answer_symbols)
+            if answer_rank < number_of_groups:
+                raise Exception(buckingham_pi_feedback_responses["TOO_FEW_INDEPENDENT_GROUPS"]("Answer", answer_rank, number_of_groups))
 
         # Compare symbols used in answer and response
-        response_symbols = set()
-        for res in response_groups:
-            response_symbols = response_symbols.union(res.free_symbols)
-        answer_symbols = set()
-        for ans in answer_groups:
-            answer_symbols = answer_symbols.union(ans.free_symbols)
+        response_symbols = response_groups.symbols
+        answer_symbols = answer_groups.symbols
         if not response_symbols.issubset(answer_symbols):
             feedback.update({"feedback": buckingham_pi_feedback_responses["UNKNOWN_SYMBOL"](response_symbols.difference(answer_symbols))})
             return {"is_correct": False, **feedback, **interp}
-        answer_symbols = list(answer_symbols)
 
         # Check ing the given response is a valid set of groups
-        reference_set = set(answer_groups)
-        reference_symbols = set(answer_symbols)
-        candidate_set = set(response_groups)
-        candidate_symbols = set(response_symbols)
-        valid, feedback_string = determine_validity(reference_set, reference_symbols, answer_original_number_of_groups, candidate_set, candidate_symbols, response_original_number_of_groups)
+        reference = BuckinghamReference(answer_groups.distinct())
+        candidate_set = response_groups.distinct()
+        valid, feedback_string = reference.validate(candidate_set)
         feedback.update({"feedback": feedback_string})
 
         # Check the special case where one groups expression contains several power products
+        # (duplicated power products do not affect the rank so the matrices from the validity analysis are reused)
         separator = "" if len(remark) == 0 else "\n"
-        answer_matrix = get_exponent_matrix(answer_groups, answer_symbols)
-        if answer_matrix.rank() > answer_number_of_groups:
+        if reference.rank > len(answer_groups):
             raise Exception(buckingham_pi_feedback_responses["SUM_WITH_INDEPENDENT_TERMS"]("answer"))
-        response_matrix = get_exponent_matrix(response_groups, answer_symbols)
-        if response_matrix.rank() > response_original_number_of_groups:
+        if candidate_set.rank(reference.symbols) > response_groups.original_number_of_groups:
             return {"is_correct": False, "feedback": buckingham_pi_feedback_responses["SUM_WITH_INDEPENDENT_TERMS"]("response")+separator+remark, **interp}
 
         return {"is_correct": valid, "feedback": feedback.get("feedback", "")+separator+remark, **interp}
@@ -373,11 +790,16 @@ def evaluation_function(response, answer, params) -> dict:
     if not (isinstance(list_of_substitutions_strings, list) and all(isinstance(element, str) for element in list_of_substitutions_strings)):
         raise Exception(parsing_feedback_responses["SUBSTITUTIONS_NOT_WRITTEN_CORRECTLY"])
 
+    timer.start("expression_to_latex")
     try:
-        interp = {"response_latex": expression_to_latex(response, parameters, parsing_params, remark)}
+        # Deferred LaTeX that cannot be computed is given as the feedback for a response that cannot be parsed
+        interp = response_latex_interpretation(
+            parameters["generate_response_latex"], expression_to_latex, response, parameters, parsing_params, remark,
+            fallback=lambda: parse_error_feedback(response, remark)
+        )
     except Exception:
-        separator = "" if len(remark) == 0 else "\n"
-        return {"is_correct": False, "feedback": parsing_feedback_responses["PARSE_ERROR_WARNING"](response)+separator+remark}
+        return parse_error_result(response, remark)
+    timer.start("other")
 
     # Perform substitutions
     substitutions = []
@@ -411,19 +833,20 @@ def evaluation_function(response, answer, params) -> dict:
             else:
                 substitutions += convert_SI_base_units_to_dimensions_short_form
 
+    timer.start("substitute")
     for sub in substitutions:
         answer = substitute(answer, sub)
         response = substitute(response, sub)
 
     # Safely try to parse answer and response into symbolic expressions
+    timer.start("parse_expression")
     try:
         match_group = re.match("0+(.0+)?\s", response)
         if match_group is not None:
             response = response[match_group.span()[1]:]
         res = parse_expression(response, parsing_params)
     except Exception:
-        separator = "" if len(remark) == 0 else "\n"
-        return {"is_correct": False, "feedback": parsing_feedback_responses["PARSE_ERROR_WARNING"](response)+separator+remark}
+        return parse_error_result(response, remark)
 
     try:
         match_group = re.match("0+(.0+)?\s", answer)
@@ -432,6 +855,7 @@ def evaluation_function(response, answer, params) -> dict:
         ans = parse_expression(answer, parsing_params)
     except Exception as e:
         raise Exception(f"SymPy was unable to parse the answer {answer}") from e
+    timer.start("comparison")
 
     # Add remarks found to feedback
     if "feedback" in feedback.keys():
@@ -470,14 +894,14 @@ def evaluation_function(response, answer, params) -> dict:
                 error_below_atol = True
             if "rtol" in parameters.keys():
                 rtol = float(parameters["rtol"])
-                error_below_rtol = bool(float(abs(((ans-res)/ans).simplify())) < rtol)
+                error_below_rtol = bool(relative_error(ans, res, rtol) < rtol)
             else:
                 if "atol" in parameters.keys():
                     error_below_rtol = True
                 elif ans == 0:
                     error_below_rtol = bool(float(abs(res)) <= sys.float_info.epsilon)
                 else:
-                    error_below_rtol = bool(float(abs(((ans-res)/ans).simplify())) < default_rtol)
+                    error_below_rtol = bool(relative_error(ans, res, default_rtol) < default_rtol)
         if error_below_atol and error_below_rtol:
             return {"is_correct": True, "comparison": parameters["comparison"], **interp, **feedback}
 
@@ -490,6 +914,36 @@ def evaluation_function(response, answer, params) -> dict:
     return {"is_correct": False, **interp, **feedback}
 
 
+def numeric_absolute_value(expr, tolerance):
+    '''
+    Input:
+        expr      : sympy expression that only contains numbers
+        tolerance : the value will be compared with this tolerance
+    Output:
+        Absolute value of expr as a float, computed with evalf with enough
+        digits that rounding errors are small compared to the tolerance, or
+        None if expr cannot be evaluated to a finite number.
+    '''
+    digits = 15
+    if tolerance > 0:
+        digits += max(0, math.ceil(-math.log10(tolerance)))
+    try:
+        value = abs(complex(expr.evalf(digits)))
+    except (TypeError, ValueError, ArithmeticError):
+        return None
+    return value if math.isfinite(value) else None
+
+def relative_error(ans, res, rtol):
+    '''
+    Returns abs((ans-res)/ans) as a float. The error is computed numerically,
+    simplification is only used if that fails (e.g. if there are symbols left).
+    '''
+    error = numeric_absolute_value((ans-res)/ans, rtol)
+    if error is None:
+        error = float(abs(((ans-res)/ans).simplify()))
+    return error
+
+
 def find_matching_parenthesis(string, index):
     depth = 0
     for k in range(index, len(string)):
@@ -504,31 +958,21 @@ def find_matching_parenthesis(string, index):
 
 
 def expression_to_latex(expression, parameters, parsing_params, remark):
-    unsplittable_symbols = parsing_params.get("unsplittable_symbols", ())
-    symbol_dict = parsing_params.get("symbol_dict", {})
     if not (len(parameters.get("quantities", [])) > 0 or parsing_params.get("elementary_functions", False) is True):
         subs = convert_short_forms
         expression = substitute(expression, subs)
+
+    # Symbols are parsed as non-commutative so that products keep the order they were written in
+    symbol_names = {}
+    if not len(parameters.get("quantities", [])) > 0:
+        parsing_params = create_order_preserving_parsing_params(parsing_params)
     try:
         expression_preview = parse_expression(expression, parsing_params)
     except Exception:
-        separator = "" if len(remark) == 0 else "\n"
-        return {"is_correct": False, "feedback": parsing_feedback_responses["PARSE_ERROR_WARNING"](expression)+separator+remark}
-
-    symbs_dic = {}
-    symbol_names = {}
+        return parse_error_feedback(expression, remark)
     if not len(parameters.get("quantities", [])) > 0:
-        symbs = expression_preview.atoms(Symbol)
-        symbs_dic = {str(x): Symbol(str(x), commutative=False) for x in symbs}
-        parsing_params_latex = parsing_params.copy()
-        parsing_params_latex["symbol_dict"] = symbs_dic
-        expression_preview = parse_expression(expression, parsing_params_latex)
-        symbol_names = {}
-        for x in symbs_dic.values():
+        for x in expression_preview.atoms(Symbol):
             symbol_names.update({x: "~\\mathrm{"+str(x)+"}"})
+
     latex_str = latex(expression_preview, symbol_names=symbol_names)
-    for symbol in symbs_dic.keys():
-        if symbol not in symbol_dict.keys() and symbol not in unsplittable_symbols:
-            if symbol in globals():
-                del globals()[symbol]
     return latex_str
@@ -1,13 +1,19 @@
-import unittest, sys
+import json, os, unittest, sys, tempfile, time
+
+from sympy import Symbol
 
 try:
-    from .evaluation import evaluation_function, buckingham_pi_feedback_responses, parsing_feedback_responses
+    from .evaluation import evaluation_function, canonical_response, relative_error, response_latex_interpretation, EvaluationResult, parse_error_feedback, buckingham_pi_feedback_responses, parsing_feedback_responses, BuckinghamReference, PowerProductGroups, determine_validity
     from .static_unit_conversion_arrays import list_of_SI_prefixes, list_of_SI_base_unit_dimensions, list_of_derived_SI_units_in_SI_base_units, list_of_very_common_units_in_SI, list_of_common_units_in_SI, convert_alternative_names_to_standard
-    from .expression_utilities import elementary_functions_names, substitute
+    from .result_cache import configure_result_cache, get_result_cache
+    from .complexity import expression_complexity, complexity_feedback_responses
+    from .expression_utilities import elementary_functions_names, substitute, compile_substitutions, create_sympy_parsing_params, parse_expression, preprocess_expression, params_fingerprint
 except ImportError:
-    from evaluation import evaluation_function, buckingham_pi_feedback_responses, parsing_feedback_responses
+    from evaluation import evaluation_function, canonical_response, relative_error, response_latex_interpretation, EvaluationResult, parse_error_feedback, buckingham_pi_feedback_responses, parsing_feedback_responses, BuckinghamReference, PowerProductGroups, determine_validity
     from static_unit_conversion_arrays import list_of_SI_prefixes, list_of_SI_base_unit_dimensions,  list_of_derived_SI_units_in_SI_base_units, list_of_very_common_units_in_SI, list_of_common_units_in_SI, convert_alternative_names_to_standard
-    from expression_utilities import elementary_functions_names, substitute
+    from result_cache import configure_result_cache, get_result_cache
+    from complexity import expression_complexity, complexity_feedback_responses
+    from expression_utilities import elementary_functions_names, substitute, compile_substitutions, create_sympy_parsing_params, parse_expression, preprocess_expression, params_fingerprint
 
 # If evaluation_tests is run with the command line argument 'skip_resource_intensive_tests'
 # then tests marked with @unittest.skipIf(skip_resource_intensive_tests, message_on_skip)
@@ -489,6 +495,18 @@ class TestEvaluationFunction(unittest.TestCase):
         params.update({"atol": "50", "rtol": "0.1"})
         self.assertEqual_input_variations(response, answer, params, False)
 
+    def test_rtol_with_irrational_answers(self):
+        params = {"rtol": 0.0001, "strict_syntax": False, "elementary_functions": True}
+        self.assertEqual_input_variations("1.6180", "(1+sqrt(5))/2", params, True)
+        self.assertEqual_input_variations("1.6185", "(1+sqrt(5))/2", params, False)
+        self.assertEqual_input_variations("3.1416", "pi", params, True)
+        params = {"rtol": 1e-13, "strict_syntax": False, "elementary_functions": True}
+        self.assertEqual_input_variations("1.6180339887499", "(1+sqrt(5))/2", params, True)
+        self.assertEqual_input_variations("1.618033988749", "(1+sqrt(5))/2", params, False)
+        # Relative errors that cannot be evaluated numerically are simplified
+        x = Symbol("x")
+        self.assertEqual(relative_error(2*x, 2*x*(1+10**-15), 1e-12) < 1e-12, True)
+
     def test_buckingham_pi_one_group(self):
         answer = "U*L/nu"
         params = {"comparison": "buckinghamPi", "input_symbols": [['U', []], ['L', []], ['nu', []]], "strict_syntax": False}
@@ -593,6 +611,14 @@ class TestEvaluationFunction(unittest.TestCase):
             result = evaluation_function(response, answer, params)
             self.assertEqual(params["custom_feedback"]["SUM_WITH_INDEPENDENT_TERMS"] in result["feedback"], True)
 
+    def test_custom_feedback_only_applies_to_its_call(self):
+        params = {"strict_syntax": False, "custom_feedback": {"PARSE_ERROR_WARNING": "Custom parse error.", "PER_FOR_DIVISION": "Custom per."}}
+        self.assertEqual(evaluation_function("x+", "x", params)["feedback"], "Custom parse error.")
+        self.assertEqual(evaluation_function("x per y", "x/y", params)["feedback"], "Custom per.")
+        params = {"strict_syntax": False}
+        self.assertEqual(evaluation_function("x+", "x", params)["feedback"], parse_error_warning("x+"))
+        self.assertEqual(evaluation_function("x per y", "x/y", params)["feedback"], parsing_feedback_responses["PER_FOR_DIVISION"])
+
     def test_buckingham_pi_too_many_groups(self):
         # This test uses the same groups as 'test_buckingham_pi_two_groups_with_custom_feedback'
         params = {"comparison": "buckinghamPi", "strict_syntax": False,
@@ -640,7 +666,8 @@ class TestEvaluationFunction(unittest.TestCase):
         answer = "U*L/nu, f*L/U"
         response = "U*L/nu, U*nu/(f*L**2)"
         result = evaluation_function(response, answer, params)
-        self.assertEqual(buckingham_pi_feedback_responses["NOT_DIMENSIONLESS"]({"$\frac{LU}{\nu}", }) in result["feedback"], True)
+        U, L, nu, f = Symbol("U"), Symbol("L"), Symbol("nu"), Symbol("f")
+        self.assertEqual(buckingham_pi_feedback_responses["NOT_DIMENSIONLESS"]({U*nu/(f*L**2)}) in result["feedback"], True)
 
     def test_buckingham_pi_two_groups_with_quantities_too_few_independent_groups_in_answer(self):
         params = {"comparison": "buckinghamPi",
@@ -697,6 +724,32 @@ class TestEvaluationFunction(unittest.TestCase):
         result = evaluation_function(response, answer, params)
         self.assertEqual(buckingham_pi_feedback_responses["TOO_FEW_INDEPENDENT_GROUPS"]("Response", 2, 3) in result["feedback"], True)
 
+    def test_buckingham_pi_reference_validates_many_candidates(self):
+        # This test uses the same groups as 'test_buckingham_pi_two_groups_with_custom_feedback'
+        g, v, h, l, q = Symbol('g'), Symbol('v'), Symbol('h'), Symbol('l'), Symbol('q')
+        reference_groups = PowerProductGroups([g**(-2)*v**4*h*l**3, g**(-2)*v**4*h**2*l**4])
+        reference = BuckinghamReference(reference_groups)
+        candidates = [
+            [g*v**(-2)*h**3*l**2, g**2*v**(-4)*h**3*l],
+            [h*l, h**2*l**2],
+            [g*v**2*h**3*l**4, g**4*v**3*h**2*l],
+            [g**(-2)*v**4*h*l**3, g**(-2)*v**4*h**2*l**4, g**(-1)*v**2*h],
+            [q*g**(-2)*v**4*h*l**3, g**(-2)*v**4*h**2*l**4],
+        ]
+        candidate_sets = [PowerProductGroups(candidate) for candidate in candidates]
+        results = list(reference.validate_all(candidate_sets))
+        self.assertEqual([valid for (valid, _) in results], [True, False, False, False, False])
+        for candidate_groups, result in zip(candidate_sets, results):
+            expected = determine_validity(
+                set(reference_groups),
+                reference_groups.symbols,
+                reference_groups.original_number_of_groups,
+                set(candidate_groups),
+                candidate_groups.symbols,
+                candidate_groups.original_number_of_groups
+            )
+            self.assertEqual(result, expected)
+
     def test_buckingham_pi_sum_with_dimensional_term(self):
         params = {
             "comparison": "buckinghamPi",
@@ -1087,6 +1140,19 @@ class TestEvaluationFunction(unittest.TestCase):
         result = evaluation_function(response, answer, params)
         self.assertEqual(result["is_correct"], True)
 
+    def test_compiled_substitutions_agree_with_substitute(self):
+        substitutions = [
+            [("abc", "p"), ("bc", "q"), ("c", "r")],
+            [("c", "r"), ("bc", "q"), ("abc", "p")],
+            [("p", "abc"), ("bc", "q"), ("c", "r")],
+            [(("a", ["b", "c"]), "x"), ("ab", "y"), (("c", []), "z")],
+            [],
+        ]
+        for string in ["abc bc c", "p bc c", "ab ac ad", "", "sin(cbca)"]:
+            for substitution in substitutions:
+                with self.subTest(string=string, substitution=substitution):
+                    self.assertEqual(compile_substitutions(substitution)(string), substitute(string, substitution))
+
     def assertEqual_elementary_function_aliases(self, answer, response, params, value):
         with self.subTest(alias_tag="name"):
             result = evaluation_function(response, answer, params)
@@ -1248,6 +1314,160 @@ class TestEvaluationFunction(unittest.TestCase):
             response = "fs/(1-Mcos(theta))"
             self.assertEqual_elementary_function_aliases(answer, response, params, True)
 
+    def test_generate_response_latex(self):
+        answer = "2*kilo*metre/hour"
+        response = "2 km/h"
+        params = {"strict_syntax": False}
+        result = evaluation_function(response, answer, params)
+        response_latex = result["response_latex"]
+        params = {"strict_syntax": False, "generate_response_latex": False}
+        result = evaluation_function(response, answer, params)
+        self.assertEqual(result["is_correct"], True)
+        self.assertEqual("response_latex" in result, False)
+        params = {"strict_syntax": False, "generate_response_latex": "lazy"}
+        result = evaluation_function(response, answer, params)
+        self.assertEqual(result["is_correct"], True)
+        self.assertEqual("response_latex" in result.keys(), False)
+        self.assertEqual(result.get("response_latex"), response_latex)
+        self.assertEqual(result["response_latex"], response_latex)
+        params = {"comparison": "buckinghamPi", "strict_syntax": False, "generate_response_latex": "lazy"}
+        result = evaluation_function("U*L/nu", "U*L/nu", params)
+        self.assertEqual(result["is_correct"], True)
+        self.assertEqual(result["response_latex"], "\\frac{L U}{\\nu}")
+        # Failures of deferred LaTeX generation give the feedback for a response that cannot be parsed
+        def failing_latex(response):
+            raise ValueError(response)
+        result = EvaluationResult(response_latex_interpretation("lazy", failing_latex, "x+", fallback=lambda: parse_error_feedback("x+", "")))
+        self.assertEqual(result["response_latex"], {"is_correct": False, "feedback": parse_error_warning("x+")})
+        with self.assertRaises(ValueError):
+            EvaluationResult(response_latex_interpretation("lazy", failing_latex, "x+"))["response_latex"]
+
+    def test_native_parser_agrees_with_sympy_parser(self):
+        expressions = [
+            "2*x**2+3*y-sin(x)/4", "-x**-2", "(a+b)/(c-d)**(1/2)", "1.5e3*m/s", ".5*x+3.", "mu*g*cos(theta)",
+            "arcsin(x)+cosec(y)", "e**x+exp(-x)", "2x y", "xy^2", "2(x+1)(x-1)", "sqrt(x^2+y^2)", "x3y",
+            "Max(x, y)", "log(x, 2)", "x.y", "f(x)", "0.[3]", "x!", "lambda: x", "I*pi", "1_000",
+        ]
+        for strict_syntax in [True, False]:
+            params = {"strict_syntax": strict_syntax, "symbols": {"mu": {}, "theta": {}}}
+            parsing_params = dict(create_sympy_parsing_params(params), elementary_functions=True)
+            for expression in expressions:
+                with self.subTest(expression=expression, strict_syntax=strict_syntax):
+                    try:
+                        expected = parse_expression(expression, dict(parsing_params, native_parser=False))
+                    except Exception as e:
+                        self.assertRaises(type(e), parse_expression, expression, parsing_params)
+                        continue
+                    self.assertEqual(parse_expression(expression, parsing_params), expected)
+
+    def test_preprocess_expression_does_not_change_params(self):
+        params = {
+            "symbols": {"mu": {"latex": r"\mu", "aliases": ["", "my", ""]}, " ": {"latex": "", "aliases": ["m"]}},
+            "input_symbols": [["", ["a"]], ["x", ["", "ex"]]],
+        }
+        original = json.dumps(params, sort_keys=True)
+        self.assertEqual(preprocess_expression(["my*ex", "m+a"], params), ["mu*x", "m+a"])
+        self.assertEqual(preprocess_expression("my", params), ["mu"])
+        self.assertEqual(json.dumps(params, sort_keys=True), original)
+
+    def test_parsing_params_are_cached(self):
+        params = {"strict_syntax": False, "symbols": {"mu": {"latex": r"\mu", "aliases": []}}}
+        parsing_params = create_sympy_parsing_params(params)
+        self.assertIs(create_sympy_parsing_params({"symbols": {"mu": {}}, "strict_syntax": False}), parsing_params)
+        self.assertIsNot(create_sympy_parsing_params({**params, "strict_syntax": True}), parsing_params)
+        self.assertRaises(TypeError, parsing_params.update, {"strict_syntax": True})
+        self.assertRaises(TypeError, parsing_params["symbol_dict"].__setitem__, "x", Symbol("x"))
+        copy = dict(parsing_params, elementary_functions=True)
+        self.assertEqual(copy["elementary_functions"], True)
+        self.assertEqual(parsing_params["elementary_functions"], False)
+
+    def test_expression_complexity(self):
+        self.assertEqual(expression_complexity("2*(x+(y-1))**3, z"), {"max_length": 17, "max_depth": 2, "max_terms": 4, "max_exponent": 3})
+        self.assertEqual(expression_complexity("10**10**10")["max_exponent"], 10**10)
+        self.assertEqual(expression_complexity("x^(-(2**3))")["max_exponent"], 8)
+        self.assertEqual(expression_complexity("9**9**9**9")["max_exponent"], float("inf"))
+        self.assertEqual(expression_complexity("x**y**2")["max_exponent"], 2)
+
+    def test_complex_responses_are_rejected(self):
+        params = {"strict_syntax": False}
+        responses = {
+            "max_length": 2001*"x",
+            "max_depth": 60*"("+"x"+60*")",
+            "max_terms": "+".join(600*["x"]),
+            "max_exponent": "10**10**10",
+        }
+        for (limit, response) in responses.items():
+            with self.subTest(limit=limit):
+                result = evaluation_function(response, "x", params)
+                self.assertEqual(result["is_correct"], False)
+                self.assertEqual("the limit is" in result["feedback"], True)
+                self.assertEqual(result["response_latex"], {"is_correct": False, "feedback": result["feedback"]})
+        # Remarks are kept and responses are checked after substitutions
+        result = evaluation_function("10**10**10 per s", "x", params)
+        self.assertEqual(result["feedback"].endswith("\n"+parsing_feedback_responses["PER_FOR_DIVISION"]), True)
+        self.assertEqual(result["response_latex"]["feedback"], result["feedback"].split("\n")[0])
+        result = evaluation_function("+".join(600*["x"]), "600*x", {"strict_syntax": False, "complexity_limits": {"max_terms": None}})
+        self.assertEqual(result["is_correct"], True)
+        result = evaluation_function("x**20", "x**20", {"strict_syntax": False, "complexity_limits": {"max_exponent": 10}})
+        self.assertEqual(result["is_correct"], False)
+        # LaTeX responses are checked before they are parsed
+        params = {"strict_syntax": False, "is_latex": True}
+        result = evaluation_function("+".join(10000*["x"]), "x", params)
+        self.assertEqual(result["feedback"], complexity_feedback_responses["max_length"](19999, 2000))
+        result = evaluation_function("+".join(600*["x"]), "x", params)
+        self.assertEqual(result["feedback"], complexity_feedback_responses["max_terms"](600, 500))
+        self.assertEqual(result["response_latex"], {"is_correct": False, "feedback": result["feedback"]})
+        params = {"strict_syntax": False}
+        # Very long responses are rejected before the key for the result cache is computed
+        with tempfile.TemporaryDirectory() as directory:
+            configure_result_cache(os.path.join(directory, "results.db"))
+            try:
+                start = time.perf_counter()
+                result = evaluation_function(200000*"x", "x", params)
+                self.assertLess(time.perf_counter()-start, 1)
+                self.assertEqual(result["feedback"], complexity_feedback_responses["max_length"](200000, 2000))
+                self.assertEqual(len(get_result_cache()), 0)
+            finally:
+                configure_result_cache(None)
+
+    def test_params_fingerprint(self):
+        params = {
+            "strict_syntax": False,
+            "symbols": {"x": {"latex": "x", "aliases": ["", "X"]}, "": {"latex": "", "aliases": []}},
+            "input_symbols": [["y", ["Y", ""]], ["", []]],
+        }
+        reordered = {"input_symbols": [["y", ["Y"]]], "request_id": 1, "symbols": {"x": {"aliases": ["X"], "latex": "x"}}, "strict_syntax": False}
+        original = json.dumps(params, sort_keys=True)
+        fingerprint = params_fingerprint(params)
+        self.assertEqual(json.dumps(params, sort_keys=True), original)
+        self.assertEqual(params_fingerprint(reordered), fingerprint)
+        preprocess_expression(["x"], params)
+        self.assertEqual(params_fingerprint(params), fingerprint)
+        self.assertNotEqual(params_fingerprint({**reordered, "strict_syntax": True}), fingerprint)
+        self.assertNotEqual(params_fingerprint({**reordered, "input_symbols": [["y", ["Y", "z"]]]}), fingerprint)
+
+    def test_canonical_response(self):
+        params = {"strict_syntax": False, "elementary_functions": True}
+        self.assertEqual(canonical_response("( x + 1 ) ^ 2 / y", params), "(x + 1)**2/y")
+        self.assertEqual(canonical_response("x / / y", params), "x / / y")
+        self.assertEqual(canonical_response("x ^ 2", {}), "x ^ 2")
+        self.assertEqual(canonical_response("x per y", params), "x per y")
+        self.assertEqual(canonical_response(1000*"x ^ 2 ", params), 1000*"x ^ 2 ")
+        with tempfile.TemporaryDirectory() as directory:
+            configure_result_cache(os.path.join(directory, "results.db"))
+            try:
+                cache = get_result_cache()
+                result = evaluation_function("sin( x ) ^ 2 / 2", "sin(x)**2/2", params)
+                for response in ["sin(x)^2/2", "sin(x) ** 2 / 2", " sin( x )**2/ 2"]:
+                    self.assertEqual(evaluation_function(response, "sin(x)**2/2", params), result)
+                self.assertEqual(len(cache), 1)
+                # Feedback for responses that cannot be parsed quotes the response, these results are not cached
+                result = evaluation_function("sin( x ) ^ / 2", "sin(x)**2/2", params)
+                self.assertEqual(result["is_correct"], False)
+                self.assertEqual(len(cache), 1)
+            finally:
+                configure_result_cache(None)
+
     def test_eval_function_can_handle_latex_input(self):
         response = r"\sin x + x^{7} + \mathrm{x} + \text { x }"
         answer = "sin(x)+x**7+x+x"
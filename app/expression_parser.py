@@ -0,0 +1,273 @@
+import operator, re
+from keyword import iskeyword
+
+from sympy import Basic, Float, Integer, Number, Symbol
+from sympy.assumptions.ask import AssumptionKeys
+from sympy.parsing.sympy_parser import _token_splittable
+
+# -------- Native parser for the restricted expression grammar
+#
+# Parses expressions built from numbers, symbols, `+`, `-`, `*`, `/`, `**`
+# (and `^` when strict_syntax is false), parentheses, implicit multiplication
+# and calls of sympy functions, and creates sympy objects directly.
+#
+# The parser is written to give exactly the same result as sympy's parse_expr
+# with the transformations used by parse_expression. Any input that is outside
+# of the restricted grammar, or that parse_expr might handle differently,
+# raises UnsupportedSyntax so that the caller can fall back to parse_expr.
+
+class UnsupportedSyntax(Exception):
+    pass
+
+_token_re = re.compile(
+    r"(?P<space>[ \t]+)"
+    r"|(?P<number>(?:[0-9]+\.[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?|[0-9]+[eE][+-]?[0-9]+|[0-9]+)"
+    r"|(?P<name>[A-Za-z_][A-Za-z0-9_]*)"
+    r"|(?P<op>\*\*|[-+*/^(),])"
+)
+
+NUMBER, VALUE, FUNCTION, OP = "number", "value", "function", "op"
+
+def tokenize(expr):
+    '''
+    Input:
+        expr : string to be split into tokens
+    Output:
+        List of pairs (kind, text) where kind is "number", "name" or "op".
+    '''
+    tokens = []
+    index = 0
+    while index < len(expr):
+        match = _token_re.match(expr, index)
+        if match is None:
+            raise UnsupportedSyntax(expr[index])
+        kind = match.lastgroup
+        text = match.group()
+        index = match.end()
+        if kind == "space":
+            continue
+        if kind == "number":
+            # Imaginary, binary, octal, hexadecimal and underscored numbers, and numbers
+            # with leading zeros, are tokenized differently by python
+            next_character = expr[index:index+1]
+            if next_character in ("j", "J", "_", "."):
+                raise UnsupportedSyntax(text+next_character)
+            if text.startswith("0") and (text.isdigit() and len(text) > 1 or next_character.isalpha()):
+                raise UnsupportedSyntax(text+next_character)
+        tokens.append((kind, text))
+    return tokens
+
+def _is_sympy_function(obj):
+    return callable(obj) and not isinstance(obj, Symbol) and getattr(obj, "__module__", "").startswith("sympy")
+
+def _resolve_defined_name(name, local_dict, global_dict):
+    '''
+    Returns the token for a name that parse_expr would look up in local_dict or
+    global_dict, or None if parse_expr would create a new symbol for the name.
+    '''
+    if name in local_dict.keys():
+        obj = local_dict[name]
+    elif name in global_dict.keys():
+        obj = global_dict[name]
+        if not (isinstance(obj, (AssumptionKeys, Basic, type)) or callable(obj)):
+            return None
+    else:
+        return None
+    if callable(obj) and not isinstance(obj, Symbol):
+        if not _is_sympy_function(obj):
+            raise UnsupportedSyntax(name)
+        return (FUNCTION, obj)
+    if not isinstance(obj, Basic):
+        raise UnsupportedSyntax(name)
+    return (VALUE, obj)
+
+def resolve_names(tokens, local_dict, global_dict, strict_syntax, can_split):
+    '''
+    Replaces names and numbers with the sympy objects they represent, in the same
+    way as the auto_symbol, auto_number and split_symbols_custom transformations.
+    '''
+    # The code generated by parse_expr looks these names up in global_dict
+    symbol_class = global_dict.get("Symbol", Symbol)
+    integer_class = global_dict.get("Integer", Integer)
+    float_class = global_dict.get("Float", Float)
+    resolved = []
+    for k, (kind, text) in enumerate(tokens):
+        if kind == "op":
+            if text == "^":
+                if strict_syntax:
+                    raise UnsupportedSyntax(text)
+                text = "**"
+            resolved.append((OP, text))
+        elif kind == "number":
+            if "." in text or "e" in text or "E" in text:
+                resolved.append((NUMBER, float_class(text)))
+            else:
+                resolved.append((NUMBER, integer_class(int(text))))
+        else:
+            if text in ("True", "False", "None") or iskeyword(text):
+                raise UnsupportedSyntax(text)
+            followed_by_parenthesis = k+1 < len(tokens) and tokens[k+1] == ("op", "(")
+            token = _resolve_defined_name(text, local_dict, global_dict)
+            if token is not None:
+                if token[0] == FUNCTION and not followed_by_parenthesis:
+                    raise UnsupportedSyntax(text)
+                if token[0] == VALUE and followed_by_parenthesis and strict_syntax:
+                    raise UnsupportedSyntax(text)
+                resolved.append(token)
+            elif followed_by_parenthesis:
+                # parse_expr creates an undefined function in this case
+                raise UnsupportedSyntax(text)
+            elif not strict_syntax and can_split(text):
+                resolved += _split_name(text, local_dict, global_dict, symbol_class)
+            else:
+                resolved.append((VALUE, symbol_class(text)))
+    return resolved
+
+def _split_name(name, local_dict, global_dict, symbol_class):
+    parts = []
+    index = 0
+    while index < len(name):
+        character = name[index]
+        if character in local_dict.keys() or character in global_dict.keys():
+            token = _resolve_defined_name(character, local_dict, global_dict)
+            if token is None or token[0] != VALUE:
+                raise UnsupportedSyntax(name)
+            parts.append(token)
+        elif character.isdigit():
+            end = index+1
+            while end < len(name) and name[end].isdigit():
+                end += 1
+            parts.append((NUMBER, global_dict.get("Number", Number)(name[index:end])))
+            index = end-1
+        else:
+            parts.append((VALUE, symbol_class(character)))
+        index += 1
+    return parts
+
+def insert_implicit_multiplication(tokens):
+    '''
+    Inserts `*` between adjacent operands, in the same way as the
+    implicit_multiplication transformation.
+    '''
+    result = []
+    for k, token in enumerate(tokens):
+        if k > 0:
+            previous = tokens[k-1]
+            ends_operand = previous[0] in (NUMBER, VALUE) or previous == (OP, ")")
+            starts_operand = token[0] in (NUMBER, VALUE, FUNCTION) or token == (OP, "(")
+            if ends_operand and starts_operand:
+                result.append((OP, "*"))
+        result.append(token)
+    return result
+
+_binary_operators = {
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "/": operator.truediv,
+}
+
+class _Parser:
+    '''
+    Recursive descent parser that follows the precedence rules of python:
+        expression := term (("+" | "-") term)*
+        term       := factor (("*" | "/") factor)*
+        factor     := ("+" | "-") factor | power
+        power      := atom ("**" factor)?
+        atom       := number | value | "(" expression ")" | function "(" expression ("," expression)* ")"
+    '''
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.index = 0
+
+    def peek(self):
+        if self.index < len(self.tokens):
+            return self.tokens[self.index]
+        return (None, None)
+
+    def expect(self, token):
+        if self.peek() != token:
+            raise UnsupportedSyntax(str(self.peek()[1]))
+        self.index += 1
+
+    def parse(self):
+        result = self.expression()
+        if self.index != len(self.tokens):
+            raise UnsupportedSyntax(str(self.peek()[1]))
+        return result
+
+    def expression(self):
+        result = self.term()
+        while self.peek() in ((OP, "+"), (OP, "-")):
+            operation = _binary_operators[self.peek()[1]]
+            self.index += 1
+            result = operation(result, self.term())
+        return result
+
+    def term(self):
+        result = self.factor()
+        while self.peek() in ((OP, "*"), (OP, "/")):
+            operation = _binary_operators[self.peek()[1]]
+            self.index += 1
+            result = operation(result, self.factor())
+        return result
+
+    def factor(self):
+        if self.peek() == (OP, "-"):
+            self.index += 1
+            return -self.factor()
+        if self.peek() == (OP, "+"):
+            self.index += 1
+            return +self.factor()
+        return self.power()
+
+    def power(self):
+        base = self.atom()
+        if self.peek() == (OP, "**"):
+            self.index += 1
+            return base**self.factor()
+        return base
+
+    def atom(self):
+        kind, value = self.peek()
+        if kind in (NUMBER, VALUE):
+            self.index += 1
+            return value
+        if kind == FUNCTION:
+            self.index += 1
+            self.expect((OP, "("))
+            arguments = [self.expression()]
+            while self.peek() == (OP, ","):
+                self.index += 1
+                arguments.append(self.expression())
+            self.expect((OP, ")"))
+            return value(*arguments)
+        if (kind, value) == (OP, "("):
+            self.index += 1
+            result = self.expression()
+            self.expect((OP, ")"))
+            return result
+        raise UnsupportedSyntax(str(value))
+
+def parse_restricted_expression(expr, local_dict, global_dict, strict_syntax=True, unsplittable_symbols=()):
+    '''
+    Input:
+        expr                 : string to be parsed into a sympy expression
+        local_dict           : dictionary of names with predefined meaning
+        global_dict          : dictionary of names from sympy, as used by parse_expr
+        strict_syntax        : if false `^` can be used for exponentiation and
+                               multiplication can be implicit
+        unsplittable_symbols : names that are not split into products of
+                               single character symbols
+    Output:
+        sympy expression, the same as parse_expr would give with the
+        transformations used by parse_expression
+    Raises:
+        UnsupportedSyntax if expr is not in the restricted grammar
+    '''
+    can_split = lambda x: False if x in unsplittable_symbols else _token_splittable(x)
+    tokens = resolve_names(tokenize(expr), local_dict, global_dict, strict_syntax, can_split)
+    if not strict_syntax:
+        tokens = insert_implicit_multiplication(tokens)
+    return _Parser(tokens).parse()
@@ -28,83 +28,125 @@ special_symbols_names = [(x, []) for x in greek_letters]
 elementary_functions_names += special_symbols_names
 elementary_functions_names.sort(key=lambda x: -len(x))
 
+# -------- Parameter Fingerprints
+
+import hashlib, json
+from functools import lru_cache
+
+# Parameters that can change the result of evaluation_function or preview_function,
+# any other parameters (e.g. added by the platform) are ignored by params_fingerprint
+graded_params_keys = (
+    "atol",
+    "comparison",
+    "complexNumbers",
+    "complexity_limits",
+    "custom_feedback",
+    "elementary_functions",
+    "generate_response_latex",
+    "input_symbols",
+    "is_latex",
+    "quantities",
+    "rtol",
+    "specialFunctions",
+    "strict_syntax",
+    "substitutions",
+    "symbols",
+    "timings",
+)
+
+def params_fingerprint(params, keys=graded_params_keys):
+    '''
+    Input:
+        params : evaluation function parameter dictionary
+        keys   : the parameters that are included in the fingerprint
+    Output:
+        String that is the same for parameter dictionaries that give the same
+        results, regardless of the order of the keys. Empty input symbols
+        and aliases are left out, since they are ignored when responses are
+        preprocessed and parsed (see input_symbol_alias_substitutions and
+        create_sympy_parsing_params). The parameters are not changed.
+    '''
+    relevant = {key: value for (key, value) in params.items() if key in keys}
+    if isinstance(relevant.get("symbols", None), dict):
+        relevant["symbols"] = {
+            code: {
+                **symbol_data,
+                "aliases": [alias for alias in symbol_data.get("aliases", []) if len(alias) > 0]
+            } if isinstance(symbol_data, dict) else symbol_data
+            for (code, symbol_data) in relevant["symbols"].items() if len(code.strip()) > 0
+        }
+    if isinstance(relevant.get("input_symbols", None), list):
+        relevant["input_symbols"] = [
+            [input_symbol[0], [alternative for alternative in input_symbol[1] if len(alternative) > 0]]
+            if len(input_symbol) > 1 else input_symbol
+            for input_symbol in relevant["input_symbols"] if len(input_symbol) == 0 or len(input_symbol[0]) > 0
+        ]
+    serialised = json.dumps(relevant, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(serialised.encode("utf-8")).hexdigest()
+
 # -------- String Manipulation Utilities
-def preprocess_expression(exprs, params):
+def input_symbol_alias_substitutions(params):
     '''
     Input:
-        exprs  : a string or a list of strings
         params : Evaluation function parameter dictionary
     Output:
-        List of strings where alternatives for input symbols have been replaced with
-        their corresponsing input symbol code.
-    Remark:
-        Alternatives are sorted before substitution so that longer alternatives takes precedence.
+        List of substitutions that replace the aliases of the input symbols
+        (and the input symbol codes) with the input symbol codes, sorted so
+        that longer aliases take precedence. Empty codes and aliases are ignored.
     '''
-    if isinstance(exprs,str):
-        exprs = [exprs]
-
     substitutions = []
-
-    if "symbols" in params.keys():
-        input_symbols = params["symbols"]
-        input_symbols_to_remove = []
-        aliases_to_remove = []
-        for (code, symbol_data) in input_symbols.items():
-            if len(code) == 0:
-                input_symbols_to_remove += [code]
-            else:
-                if len(code.strip()) == 0:
-                    input_symbols_to_remove += [code]
-                else:
-                    aliases = symbol_data["aliases"]
-                    for i in range(0,len(aliases)):
-                        if len(aliases[i]) > 0:
-                            aliases[i].strip()
-                        if len(aliases[i]) == 0:
-                            aliases_to_remove += [(code,i)]
-        for (code,i) in aliases_to_remove:
-            del input_symbols[code]["aliases"][i]
-        for code in input_symbols_to_remove:
-            del input_symbols[code]
-        for (code, symbol_data) in input_symbols.items():
+    for (code, symbol_data) in params.get("symbols", {}).items():
+        if len(code.strip()) > 0:
             substitutions.append((code,code))
-            for alias in symbol_data["aliases"]:
+            for alias in symbol_data.get("aliases", []):
                 if len(alias) > 0:
                     substitutions.append((alias,code))
 
     # REMARK: This is to ensure capability with response areas that use the old formatting
     # for input_symbols. Should be removed when all response areas are updated.
-    if "input_symbols" in params.keys():
-        input_symbols = params["input_symbols"]
-        input_symbols_to_remove = []
-        alternatives_to_remove = []
-        for k in range(0, len(input_symbols)):
-            if len(input_symbols[k]) > 0:
-                input_symbols[k][0].strip()
-                if len(input_symbols[k][0]) == 0:
-                    input_symbols_to_remove += [k]
-            else:
-                for i in range(0, len(input_symbols[k][1])):
-                    if len(input_symbols[k][1][i]) > 0:
-                        input_symbols[k][1][i].strip()
-                    if len(input_symbols[k][1][i]) == 0:
-                        alternatives_to_remove += [(k, i)]
-        for (k, i) in alternatives_to_remove:
-            del input_symbols[k][1][i]
-        for k in input_symbols_to_remove:
-            del input_symbols[k]
-        for input_symbol in params["input_symbols"]:
+    for input_symbol in params.get("input_symbols", []):
+        if len(input_symbol) > 0 and len(input_symbol[0]) > 0:
             substitutions.append((input_symbol[0], input_symbol[0]))
             for alternative in input_symbol[1]:
                 if len(alternative) > 0:
                     substitutions.append((alternative, input_symbol[0]))
 
-    if len(substitutions) > 0:
-        substitutions.sort(key=lambda x: -len(x[0]))
-        for k in range(0,len(exprs)):
-            exprs[k] = substitute(exprs[k], substitutions)
+    substitutions.sort(key=lambda x: -len(x[0]))
+    return substitutions
 
-    return exprs
+def input_symbol_alias_matcher(params):
+    '''
+    Input:
+        params : Evaluation function parameter dictionary
+    Output:
+        Function that takes a string and replaces aliases for input symbols
+        with their input symbol code. The function is compiled once for each
+        table of aliases and reused.
+    '''
+    if "symbols" not in params.keys() and "input_symbols" not in params.keys():
+        return lambda string: string
+    return compiled_alias_matcher(tuple(input_symbol_alias_substitutions(params)))
+
+@lru_cache(maxsize=256)
+def compiled_alias_matcher(substitutions):
+    return compile_substitutions(substitutions)
+
+def preprocess_expression(exprs, params):
+    '''
+    Input:
+        exprs  : a string or a list of strings
+        params : Evaluation function parameter dictionary
+    Output:
+        List of strings where alternatives for input symbols have been replaced with
+        their corresponsing input symbol code.
+    Remark:
+        Alternatives are sorted before substitution so that longer alternatives takes precedence.
+        params is not changed.
+    '''
+    if isinstance(exprs,str):
+        exprs = [exprs]
+    substitute_aliases = input_symbol_alias_matcher(params)
+    return [substitute_aliases(expr) if isinstance(expr, str) else expr for expr in exprs]
 
 def substitute(string, substitutions):
     '''
@@ -175,11 +217,98 @@ def substitute(string, substitutions):
 
     return "".join(new_string)
 
+def compile_substitutions(substitutions):
+    '''
+    Input:
+        substitutions (required) : a list of substitutions in the same form as for substitute
+    Output:
+        A function that takes a string and returns the same string as
+        substitute(string, substitutions) but that does all matching with a
+        single precompiled regular expression.
+    Remarks:
+        The alternatives of a regular expression are tried in order at each position,
+        so the first substitution in the list that matches is used, just as in substitute.
+        Alternatives are grouped by their first character, so that at each position
+        only the substitutions that start with the character at that position are tried.
+        Substitutions with an empty left element are ignored.
+    '''
+    groups = {}
+    for left, right in substitutions:
+        if isinstance(left, tuple):
+            if len(left[1]) == 0:
+                continue
+            string = left[0]
+            look_ahead = "(?="+"|".join(re.escape(x) for x in left[1])+")"
+        else:
+            string = left
+            look_ahead = ""
+        if len(string) > 0:
+            groups.setdefault(string[0], []).append(("("+re.escape(string[1:])+look_ahead+")", right))
+    if len(groups) == 0:
+        return lambda string: string
+    alternatives = []
+    replacements = [None]
+    for first, group in groups.items():
+        alternatives.append(re.escape(first)+"(?:"+"|".join(alternative for alternative, _ in group)+")")
+        replacements += [right for _, right in group]
+    pattern = re.compile("|".join(alternatives))
+    return lambda string: pattern.sub(lambda match: replacements[match.lastindex], string)
+
 # -------- (Sympy) Expression Parsing Utilities
 
+import builtins, re, types
 from sympy.parsing.sympy_parser import parse_expr, split_symbols_custom, _token_splittable
 from sympy.parsing.sympy_parser import T as parser_transformations
-from sympy import Symbol
+from sympy import Symbol, Max, Min
+try:
+    from .expression_parser import parse_restricted_expression
+    from .metrics import count
+except ImportError:
+    from expression_parser import parse_restricted_expression
+    from metrics import count
+
+def create_sympy_global_dict(symbol_class=Symbol):
+    '''
+    Input:
+        symbol_class : function used to create symbols during parsing
+    Output:
+        Dictionary with the same contents as the dictionary sympy's parse_expr
+        uses as global_dict by default, except that the name `Symbol` refers
+        to symbol_class.
+    '''
+    global_dict = {}
+    exec('from sympy import *', global_dict)
+    for name, obj in vars(builtins).items():
+        if isinstance(obj, types.BuiltinFunctionType):
+            global_dict[name] = obj
+    global_dict['max'] = Max
+    global_dict['min'] = Min
+    global_dict['Symbol'] = symbol_class
+    return global_dict
+
+def noncommutative_symbol(name, **assumptions):
+    return Symbol(name, commutative=False, **assumptions)
+
+default_global_dict = create_sympy_global_dict()
+noncommutative_global_dict = create_sympy_global_dict(noncommutative_symbol)
+
+class FrozenDict(dict):
+    '''
+    Dictionary that can not be changed, used for values that are cached and
+    shared between calls. Copies (made with copy or dict) can be changed.
+    '''
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("FrozenDict can not be changed, change a copy instead")
+
+    __setitem__ = __delitem__ = __ior__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def copy(self):
+        return dict(self)
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
 
 def create_sympy_parsing_params(params, unsplittable_symbols=tuple()):
     '''
@@ -190,35 +319,53 @@ def create_sympy_parsing_params(params, unsplittable_symbols=tuple()):
     Output:
         parsing_params: A dictionary that contains necessary info for the
                         parse_expression function.
+    Remark:
+        The parsing params are cached for each combination of the parameters
+        that are used to create them and shared between calls, so they can
+        not be changed (use a copy to change them).
     '''
 
     if "symbols" in params.keys():
         to_keep = []
         for symbol in params["symbols"].keys():
-            if len(symbol) > 1:
+            if len(symbol) > 1 and len(symbol.strip()) > 0:
                 to_keep.append(symbol)
-        unsplittable_symbols += tuple(to_keep)
+        unsplittable_symbols = tuple(unsplittable_symbols)+tuple(to_keep)
 
     if "input_symbols" in params.keys():
         to_keep = []
         for symbol in [x[0] for x in params["input_symbols"]]:
             if len(symbol) > 1:
                 to_keep.append(symbol)
-        unsplittable_symbols += tuple(to_keep)
+        unsplittable_symbols = tuple(unsplittable_symbols)+tuple(to_keep)
+
+    arguments = (
+        tuple(unsplittable_symbols),
+        params.get("specialFunctions", False) == True,
+        params.get("complexNumbers", False) == True,
+        params.get("elementary_functions", False),
+        params.get("strict_syntax", True),
+    )
+    try:
+        return cached_sympy_parsing_params(*arguments)
+    except TypeError:
+        # Parameter values that can not be hashed
+        return cached_sympy_parsing_params.__wrapped__(*arguments)
 
-    if params.get("specialFunctions", False) == True:
+@lru_cache(maxsize=256, typed=True)
+def cached_sympy_parsing_params(unsplittable_symbols, special_functions, complex_numbers, elementary_functions, strict_syntax):
+    if special_functions:
         from sympy import beta, gamma, zeta
     else:
         beta = Symbol("beta")
         gamma = Symbol("gamma")
         zeta = Symbol("zeta")
-    if params.get("complexNumbers", False) == True:
+    if complex_numbers:
         from sympy import I
     else:
         I = Symbol("I")
-    if params.get("elementary_functions", False) == True:
+    if elementary_functions == True:
         from sympy import E
-        e = E
     else:
         E = Symbol("E")
     N = Symbol("N")
@@ -240,11 +387,51 @@ def create_sympy_parsing_params(params, unsplittable_symbols=tuple()):
     for symbol in unsplittable_symbols:
         symbol_dict.update({symbol: Symbol(symbol)})
 
-    strict_syntax = params.get("strict_syntax",True)
+    parsing_params = {"unsplittable_symbols": unsplittable_symbols, "strict_syntax": strict_syntax, "symbol_dict": FrozenDict(symbol_dict), "extra_transformations": tuple(), "elementary_functions": elementary_functions}
+
+    return FrozenDict(parsing_params)
+
+def create_order_preserving_parsing_params(parsing_params):
+    '''
+    Input:
+        parsing_params : dictionary that contains parsing parameters
+    Output:
+        Copy of parsing_params for which parse_expression creates non-commutative
+        symbols. Products in expressions parsed this way keep the order they are
+        written in, which is used when generating LaTeX previews.
+    '''
+    symbol_dict = {}
+    for (name, value) in parsing_params.get("symbol_dict",{}).items():
+        if isinstance(value, Symbol):
+            value = noncommutative_symbol(value.name)
+        symbol_dict.update({name: value})
+    order_preserving_parsing_params = parsing_params.copy()
+    order_preserving_parsing_params.update({"symbol_dict": symbol_dict, "global_dict": noncommutative_global_dict})
+    return order_preserving_parsing_params
 
-    parsing_params = {"unsplittable_symbols": unsplittable_symbols, "strict_syntax": strict_syntax, "symbol_dict": symbol_dict, "extra_transformations": tuple(), "elementary_functions": params.get("elementary_functions",False)}
+alias_substitutions = []
+for (name,alias) in elementary_functions_names:
+    alias_substitutions += [(name,name)] + [(x,name) for x in alias]
+alias_substitutions.sort(key=lambda x: -len(x[0]))
+compiled_alias_substitutions = compile_substitutions(alias_substitutions)
 
-    return parsing_params
+@lru_cache(maxsize=256)
+def parse_expression_substitutions(unsplittable_symbols, elementary_functions):
+    '''
+    Input:
+        unsplittable_symbols : tuple of strings that will not be split when parsing
+        elementary_functions : if true, aliases for elementary functions are replaced
+                               with the names sympy uses
+    Output:
+        Tuple of functions that are applied to the expression, in order, by
+        parse_expression before it is parsed.
+    '''
+    separate_unsplittable_symbols = [(x," "+x+" ") for x in unsplittable_symbols]
+    if elementary_functions:
+        separate_unsplittable_symbols = [(x[0]," "+x[0]) for x in elementary_functions_names] + separate_unsplittable_symbols
+        separate_unsplittable_symbols.sort(key=lambda x: -len(x[0]))
+        return (compiled_alias_substitutions, compile_substitutions(separate_unsplittable_symbols))
+    return (compile_substitutions(separate_unsplittable_symbols),)
 
 def parse_expression(expr, parsing_params):
     '''
@@ -260,20 +447,24 @@ def parse_expression(expr, parsing_params):
     extra_transformations = parsing_params.get("extra_transformations",())
     unsplittable_symbols = parsing_params.get("unsplittable_symbols",())
     symbol_dict = parsing_params.get("symbol_dict",{})
-    separate_unsplittable_symbols = [(x," "+x+" ") for x in unsplittable_symbols]
-    if parsing_params["elementary_functions"] == True:
-        alias_substitutions = []
-        for (name,alias) in elementary_functions_names:
-            alias_substitutions += [(name,name)] + [(x,name) for x in alias]
-        alias_substitutions.sort(key=lambda x: -len(x[0]))
-        expr = substitute(expr,alias_substitutions)
-        separate_unsplittable_symbols = [(x[0]," "+x[0]) for x in elementary_functions_names] + separate_unsplittable_symbols
-        separate_unsplittable_symbols.sort(key=lambda x: -len(x[0]))
-    expr = substitute(expr,separate_unsplittable_symbols)
+    global_dict = parsing_params.get("global_dict",default_global_dict)
+    elementary_functions = parsing_params["elementary_functions"] == True
+    for substitution in parse_expression_substitutions(tuple(unsplittable_symbols),elementary_functions):
+        expr = substitution(expr)
+    if parsing_params.get("native_parser",True) and len(extra_transformations) == 0:
+        try:
+            parsed_expr = parse_restricted_expression(expr,symbol_dict,global_dict,strict_syntax,unsplittable_symbols)
+            count("parsed_expressions", parser="native")
+            return parsed_expr
+        except Exception:
+            # Anything the native parser does not handle is left to parse_expr
+            count("parsed_expressions", parser="native_fallback")
     can_split = lambda x: False if x in unsplittable_symbols else _token_splittable(x)
     if strict_syntax:
         transformations = parser_transformations[0:4]+extra_transformations
     else:
         transformations = parser_transformations[0:4,6]+extra_transformations+(split_symbols_custom(can_split),)+parser_transformations[8]
-    parsed_expr = parse_expr(expr,transformations=transformations,local_dict=symbol_dict)
+    # parse_expr can change local_dict and symbol_dict is shared between calls, so it is given a copy
+    parsed_expr = parse_expr(expr,transformations=transformations,local_dict=dict(symbol_dict),global_dict=global_dict)
+    count("parsed_expressions", parser="sympy")
     return parsed_expr
\ No newline at end of file
@@ -0,0 +1,83 @@
+import argparse, json, sys
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+try:
+    from .request_log import normalise_request, handle_request, bounded_map
+except ImportError:
+    from request_log import normalise_request, handle_request, bounded_map
+
+# -------- Command line grader
+#
+# Grades a stream of requests, in the request log format (see request_log.py),
+# and writes one JSON result per line to stdout (or a file) in input order:
+#
+#     python -m app.grade [INPUT] [--workers N] [--mode threads|processes] [--output FILE]
+#
+# INPUT is a file, or - (the default) for stdin. Each output line is
+# {"result": ...} or, if the request could not be graded, {"error": ...}.
+# If a request has an `id` it is copied to the output line. Results are
+# written as soon as they (and all results before them) are done and at
+# most a fixed number of requests are in flight, so memory use does not
+# grow with the size of the input.
+
+def grade_line(line):
+    '''
+    Input:
+        line : a line with a request in the request log format
+    Output:
+        String with the JSON output line (without line break)
+    '''
+    output = {}
+    try:
+        request = json.loads(line)
+        if isinstance(request, dict) and "id" in request.keys():
+            output["id"] = request["id"]
+        output["result"] = handle_request(normalise_request(request))
+    except Exception as e:
+        output["error"] = str(e) if len(str(e)) > 0 else repr(e)
+    return json.dumps(output, default=str)
+
+def grade_lines(lines, workers=1, mode="processes", in_flight=None):
+    '''
+    Input:
+        lines     : iterable of lines in the request log format, empty lines are skipped
+        workers   : number of threads or processes, if 1 the lines are graded in this process
+        mode      : "threads" or "processes"
+        in_flight : maximum number of lines that are being graded at the same time,
+                    by default 4*workers
+    Output:
+        Generator that yields the output lines (see grade_line) in input order
+    '''
+    lines = (line for line in lines if len(line.strip()) > 0)
+    if workers <= 1:
+        yield from map(grade_line, lines)
+        return
+    if mode not in ("threads", "processes"):
+        raise ValueError(f"Unknown mode {mode}, must be threads or processes")
+    executor_class = ThreadPoolExecutor if mode == "threads" else ProcessPoolExecutor
+    with executor_class(max_workers=workers) as executor:
+        yield from bounded_map(executor, grade_line, lines, in_flight or 4*workers)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Grade a stream of requests in the request log format.")
+    parser.add_argument("input", nargs="?", default="-", help="file with one request per line, - for stdin")
+    parser.add_argument("--output", help="write the results to this file instead of stdout")
+    parser.add_argument("--workers", type=int, default=1, help="number of threads or processes used for grading")
+    parser.add_argument("--mode", choices=["threads", "processes"], default="processes")
+    parser.add_argument("--in-flight", type=int, help="maximum number of requests graded at the same time (default 4*workers)")
+    args = parser.parse_args(argv)
+
+    input_file = sys.stdin if args.input == "-" else open(args.input)
+    output_file = sys.stdout if args.output is None else open(args.output, "w")
+    try:
+        for output_line in grade_lines(input_file, workers=args.workers, mode=args.mode, in_flight=args.in_flight):
+            output_file.write(output_line+"\n")
+            output_file.flush()
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+        if output_file is not sys.stdout:
+            output_file.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import os, sys, threading
+
+from sympy.core.cache import CACHE, SYMPY_CACHE_SIZE, clear_cache
+
+# -------- Memory use of long-running processes
+#
+# sympy caches the results of many of its functions (see sympy.core.cache).
+# Each cached function keeps up to SYMPY_CACHE_SIZE results (1000 by
+# default, set with the environment variable SYMPY_CACHE_SIZE before sympy
+# is imported), so in a process that grades many responses the caches fill
+# up with expressions from earlier calls and the memory used grows. The
+# caches can be cleared between calls, every `interval` calls and/or when
+# the resident memory of the process is above `memory_limit` bytes (checked
+# every memory_check_interval calls, since the memory of a process usually
+# does not shrink when the caches are cleared). This is configured with
+# configure_cache_trimming or with the environment variables below (the
+# memory limit is given in megabytes).
+
+sympy_cache_trim_interval_environment_variable = "EVALUATION_SYMPY_CACHE_TRIM_INTERVAL"
+memory_limit_environment_variable = "EVALUATION_MEMORY_LIMIT"
+
+memory_check_interval = 100
+
+def memory_usage():
+    '''
+    Returns the resident memory of the process in bytes. If the current
+    value is not available (outside Linux) the peak value is returned, and
+    None if neither is available.
+    '''
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1])*os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak*1024
+
+def sympy_cache_entries():
+    '''
+    Returns the number of results stored in sympy's caches.
+    '''
+    return sum(function.cache_info().currsize for function in CACHE if hasattr(function, "cache_info"))
+
+def memory_report():
+    return {
+        "rss": memory_usage(),
+        "sympy_cache_entries": sympy_cache_entries(),
+        "sympy_cache_size": SYMPY_CACHE_SIZE,
+        "sympy_cache_trims": _trim_settings["trims"],
+    }
+
+
+_trim_settings = {
+    "interval": int(os.environ.get(sympy_cache_trim_interval_environment_variable, "") or 0),
+    "memory_limit": int(float(os.environ.get(memory_limit_environment_variable, "") or 0)*1024*1024) or None,
+    "calls": 0,
+    "trims": 0,
+}
+_trim_lock = threading.Lock()
+
+def configure_cache_trimming(interval=0, memory_limit=None):
+    '''
+    Input:
+        interval     : sympy's caches are cleared every `interval` calls, 0 turns this off
+        memory_limit : sympy's caches are cleared if the resident memory of the process
+                       is above this many bytes, None turns this off
+    '''
+    with _trim_lock:
+        _trim_settings["interval"] = int(interval)
+        _trim_settings["memory_limit"] = memory_limit
+        _trim_settings["calls"] = 0
+
+def trim_caches_between_calls():
+    '''
+    Called before each call of evaluation_function and preview_function,
+    clears sympy's caches if the configured interval or memory limit is
+    reached. Returns True if the caches were cleared.
+    '''
+    interval = _trim_settings["interval"]
+    memory_limit = _trim_settings["memory_limit"]
+    if interval <= 0 and memory_limit is None:
+        return False
+    with _trim_lock:
+        _trim_settings["calls"] += 1
+        calls = _trim_settings["calls"]
+    trim = interval > 0 and calls % interval == 0
+    if not trim and memory_limit is not None and calls % memory_check_interval == 0:
+        usage = memory_usage()
+        trim = usage is not None and usage > memory_limit
+    if trim:
+        clear_cache()
+        with _trim_lock:
+            _trim_settings["trims"] += 1
+    return trim
@@ -0,0 +1,187 @@
+import atexit, json, os, threading
+
+try:
+    from .timing import TimingHistogram, env_flag
+except ImportError:
+    from timing import TimingHistogram, env_flag
+
+# -------- Metrics
+#
+# Counters (e.g. evaluations per comparison mode and outcome, result cache
+# hits, which parser was used) and latency histograms (per comparison mode
+# and per stage) are collected in an in-process registry when the
+# environment variable EVALUATION_METRICS is set to something other than
+# "", "0" or "false", or after configure_metrics(True). When metrics are
+# not enabled the functions that record metrics return immediately.
+#
+# The metrics can be exported as JSON or in the Prometheus text format with
+# write_metrics, or at exit to the file given by EVALUATION_METRICS_FILE
+# (the format is chosen by the file extension, ".prom" or ".txt" for
+# Prometheus, and "{pid}" in the name is replaced by the process id). The
+# local grading server (server.py) serves the metrics of all its worker
+# processes on GET /metrics.
+
+metrics_environment_variable = "EVALUATION_METRICS"
+metrics_file_environment_variable = "EVALUATION_METRICS_FILE"
+
+prometheus_extensions = (".prom", ".txt")
+
+
+class MetricsRegistry:
+    '''
+    Counters and histograms, each identified by a name and a dictionary of labels.
+    '''
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, labels, amount=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0)+amount
+
+    def observe(self, name, labels, seconds):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key, None)
+            if histogram is None:
+                histogram = TimingHistogram()
+                self._histograms[key] = histogram
+            histogram.observe(seconds)
+
+    def snapshot(self, reset=False):
+        '''
+        Output:
+            Dictionary with a list of counters and a list of histograms (in
+            the form returned by TimingHistogram.to_dict), each with its
+            name and labels. If reset is true the registry is emptied.
+        '''
+        with self._lock:
+            snapshot = {
+                "counters": [{"name": name, "labels": dict(labels), "value": value} for ((name, labels), value) in self._counters.items()],
+                "histograms": [{"name": name, "labels": dict(labels), **histogram.to_dict()} for ((name, labels), histogram) in self._histograms.items()],
+            }
+            if reset:
+                self._counters.clear()
+                self._histograms.clear()
+        return snapshot
+
+    def merge(self, snapshot):
+        '''
+        Adds the counters and histograms in a snapshot (e.g. from another
+        process) to the registry.
+        '''
+        for counter in snapshot["counters"]:
+            self.increment(counter["name"], counter["labels"], counter["value"])
+        with self._lock:
+            for data in snapshot["histograms"]:
+                key = (data["name"], tuple(sorted(data["labels"].items())))
+                histogram = self._histograms.get(key, None)
+                if histogram is None:
+                    histogram = TimingHistogram(data["bounds"])
+                    self._histograms[key] = histogram
+                histogram.merge(data)
+
+    def reset(self):
+        self.snapshot(reset=True)
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self):
+        '''
+        Returns the metrics in the Prometheus text exposition format.
+        '''
+        snapshot = self.snapshot()
+        lines = []
+        for name in sorted({counter["name"] for counter in snapshot["counters"]}):
+            lines.append(f"# TYPE {name}_total counter")
+            for counter in snapshot["counters"]:
+                if counter["name"] == name:
+                    lines.append(f"{name}_total{prometheus_labels(counter['labels'])} {counter['value']}")
+        for name in sorted({histogram["name"] for histogram in snapshot["histograms"]}):
+            lines.append(f"# TYPE {name} histogram")
+            for histogram in snapshot["histograms"]:
+                if histogram["name"] != name:
+                    continue
+                cumulative = 0
+                for (bound, count) in zip(histogram["bounds"]+["+Inf"], histogram["counts"]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{prometheus_labels({**histogram['labels'], 'le': str(bound)})} {cumulative}")
+                lines.append(f"{name}_sum{prometheus_labels(histogram['labels'])} {histogram['sum']}")
+                lines.append(f"{name}_count{prometheus_labels(histogram['labels'])} {histogram['count']}")
+        return "\n".join(lines)+"\n"
+
+def prometheus_labels(labels):
+    if len(labels) == 0:
+        return ""
+    escape = lambda value: str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    return "{"+",".join(f"{name}=\"{escape(value)}\"" for (name, value) in sorted(labels.items()))+"}"
+
+
+metrics = MetricsRegistry()
+
+_metrics_settings = {
+    "enabled": env_flag(metrics_environment_variable),
+}
+
+def configure_metrics(enabled=True):
+    _metrics_settings["enabled"] = enabled
+
+def metrics_enabled():
+    return _metrics_settings["enabled"]
+
+def count(name, **labels):
+    '''
+    Increments the counter with the given name and labels by one, if metrics are enabled.
+    '''
+    if _metrics_settings["enabled"]:
+        metrics.increment(name, labels)
+
+def observe(name, seconds, **labels):
+    '''
+    Adds a duration to the histogram with the given name and labels, if metrics are enabled.
+    '''
+    if _metrics_settings["enabled"]:
+        metrics.observe(name, labels, seconds)
+
+def observe_timings(name, timings, **labels):
+    '''
+    Adds stage timings (see timing.py) to the histogram with the given name,
+    with the stage as an extra label, if metrics are enabled.
+    '''
+    if _metrics_settings["enabled"]:
+        for (stage, seconds) in timings.items():
+            metrics.observe(name, {**labels, "stage": stage}, seconds)
+
+def drain_metrics():
+    '''
+    Returns a snapshot of the metrics and empties the registry, or None if
+    metrics are not enabled. Used to send the metrics of a worker process
+    to the process that collects them.
+    '''
+    if not _metrics_settings["enabled"]:
+        return None
+    return metrics.snapshot(reset=True)
+
+def write_metrics(path, format=None):
+    '''
+    Input:
+        path   : file that the metrics are written to, "{pid}" is replaced by the process id
+        format : "json" or "prometheus", by default chosen by the extension of path
+    '''
+    path = path.replace("{pid}", str(os.getpid()))
+    if format is None:
+        format = "prometheus" if path.endswith(prometheus_extensions) else "json"
+    text = metrics.to_prometheus() if format == "prometheus" else metrics.to_json()
+    with open(path, "w") as file:
+        file.write(text)
+
+def _write_metrics_at_exit():
+    path = os.environ.get(metrics_file_environment_variable, "")
+    if _metrics_settings["enabled"] and len(path) > 0:
+        write_metrics(path)
+
+atexit.register(_write_metrics_at_exit)
@@ -1,12 +1,21 @@
 import re
-from typing import Any, Dict, List, TypedDict
+import threading
+from time import perf_counter
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Any, Dict, List, TypedDict, Union
 
 from sympy import simplify, latex, Symbol, Integer, Add, Subs, pi, posify
 import sympy
 from latex2sympy2 import latex2sympy
 
 from .static_unit_conversion_arrays import convert_short_forms, convert_to_SI_base_units, convert_to_SI_base_units_short_form, convert_SI_base_units_to_dimensions, convert_SI_base_units_to_dimensions_short_form, names_of_prefixes_units_and_dimensions, convert_alternative_names_to_standard
-from .expression_utilities import preprocess_expression, parse_expression, create_sympy_parsing_params, substitute
+from .expression_utilities import preprocess_expression, parse_expression, create_sympy_parsing_params, create_order_preserving_parsing_params, substitute, params_fingerprint
+from .profiling import slow_call_capture
+from .complexity import check_expression_length, check_expression_complexity, ExpressionTooComplex
+from .memory import trim_caches_between_calls
+from .metrics import count, observe, metrics_enabled
 
 class Params(TypedDict):
     pass
@@ -45,6 +54,49 @@ def extract_latex(symbol):
 
     return match.group("latex")
 
+@lru_cache(maxsize=128)
+def _latex_symbol_substitutions(symbols_fingerprint):
+    substitutions = {}
+
+    for (sympy_symbol_str, symbol_str) in symbols_fingerprint:
+        latex_symbol_str = extract_latex(symbol_str)
+
+        try:
+            latex_symbol = latex2sympy(latex_symbol_str)
+        except Exception:
+            raise ValueError(
+                f"Couldn't parse latex symbol {latex_symbol_str} "
+                f"to sympy symbol."
+            )
+
+        substitutions[latex_symbol] = sympy.Symbol(sympy_symbol_str)
+
+    return substitutions
+
+def latex_symbol_substitutions(symbols: SymbolDict) -> Dict[Any, sympy.Symbol]:
+    """Returns a map from the parsed LaTeX of each symbol to its sympy symbol.
+
+    Note:
+        The symbol table for a question does not change between calls, so the
+        maps are cached (with bounded size) by the codes and LaTeX strings of
+        the symbols. The returned dictionary is a copy and can be modified.
+
+    Args:
+        symbols (SymbolDict): A mapping of sympy symbol strings and LaTeX
+        symbol strings.
+
+    Raises:
+        ValueError: If the LaTeX for a symbol couldn't be parsed.
+
+    Returns:
+        Dict[Any, sympy.Symbol]: The substitutions to make after parsing.
+    """
+    symbols_fingerprint = tuple(
+        (sympy_symbol_str, symbols[sympy_symbol_str]["latex"])
+        for sympy_symbol_str in symbols
+    )
+    return dict(_latex_symbol_substitutions(symbols_fingerprint))
+
 def parse_latex(response: str, symbols: SymbolDict) -> str:
     """Parse a LaTeX string to a sympy string while preserving custom symbols.
 
@@ -59,21 +111,7 @@ def parse_latex(response: str, symbols: SymbolDict) -> str:
     Returns:
         str: The expression in sympy syntax.
     """
-    substitutions = {}
-
-    for sympy_symbol_str in symbols:
-        symbol_str = symbols[sympy_symbol_str]["latex"]
-        latex_symbol_str = extract_latex(symbol_str)
-
-        try:
-            latex_symbol = latex2sympy(latex_symbol_str)
-        except Exception:
-            raise ValueError(
-                f"Couldn't parse latex symbol {latex_symbol_str} "
-                f"to sympy symbol."
-            )
-
-        substitutions[latex_symbol] = sympy.Symbol(sympy_symbol_str)
+    substitutions = latex_symbol_substitutions(symbols)
 
     try:
         expression = latex2sympy(response, substitutions)
@@ -87,32 +125,24 @@ def parse_latex(response: str, symbols: SymbolDict) -> str:
         raise ValueError(str(e))
 
 def expression_to_latex(expression,parameters,parsing_params):
-    unsplittable_symbols = parsing_params.get("unsplittable_symbols",())
-    symbol_dict = parsing_params.get("symbol_dict",{})
     if not (len(parameters.get("quantities",[])) > 0 or parsing_params.get("elementary_functions",False) == True or parsing_params.get("comparison","") == "buckinghamPi"):
         subs = convert_short_forms
         expression = substitute(expression,subs)
+
+    # Symbols are parsed as non-commutative so that products keep the order they were written in
+    symbol_names = {}
+    if not len(parameters.get("quantities",[])) > 0:
+        parsing_params = create_order_preserving_parsing_params(parsing_params)
     try:
         expression_preview = parse_expression(expression,parsing_params)
     except Exception as exc:
         raise ValueError("Cannot parse response") from exc
-
-    symbs_dic = {}
-    symbol_names = {}
     if not len(parameters.get("quantities",[])) > 0:
-        symbs = expression_preview.atoms(Symbol)
-        symbs_dic = {str(x): Symbol(str(x),commutative=False) for x in symbs}
-        parsing_params_latex = parsing_params.copy()
-        parsing_params_latex["symbol_dict"] = symbs_dic
-        expression_preview = parse_expression(expression,parsing_params_latex)
-        for x in symbs_dic.values():
+        for x in expression_preview.atoms(Symbol):
             symbol_names.update({x: "~\\mathrm{"+str(x)+"}"})
+
     latex_str = latex(expression_preview,symbol_names=symbol_names)
     sympy_str = str(expression_preview)
-    for symbol in symbs_dic.keys():
-        if symbol not in symbol_dict.keys() and symbol not in unsplittable_symbols:
-            if symbol in globals():
-                del(globals()[symbol])
     return latex_str, sympy_str
 
 def find_matching_parenthesis(string, index, delimiters=None):
@@ -129,26 +159,54 @@ def find_matching_parenthesis(string, index, delimiters=None):
                 return k
     return -1
 
-def sanitise_latex(response):
-    response = response.replace('~',' ')
-    response = "".join(response.split())
-    wrappers = [r"\mathrm",r"\text"]
-    for wrapper in wrappers:
-        processed_response = []
-        index = 0
-        while index < len(response):
-            wrapper_start = response.find(wrapper+"{", index)
-            if wrapper_start > -1:
-                processed_response.append(response[index:wrapper_start])
-                wrapper_end = find_matching_parenthesis(response, wrapper_start+1, delimiters=('{','}'))
-                inside_wrapper = response[(wrapper_start+len(wrapper+"{")):wrapper_end]
-                processed_response.append(inside_wrapper)
-                index = wrapper_end+1
+latex_wrappers = (r"\mathrm", r"\text")
+
+@lru_cache(maxsize=16)
+def _latex_wrapper_res(wrappers):
+    wrapper_pattern = "|".join(re.escape(wrapper)+r"\{" for wrapper in wrappers)
+    return re.compile(wrapper_pattern), re.compile(wrapper_pattern+"|[{}]")
+
+def sanitise_latex(response, wrappers=latex_wrappers):
+    """Removes whitespace, `~` and wrapper commands from a LaTeX string.
+
+    Note:
+        The string is scanned once. Braces are only tracked inside wrappers,
+        nested wrappers are removed as well and the contents of a wrapper
+        that is never closed are kept.
+
+    Args:
+        response (str): The LaTeX string to sanitise.
+        wrappers (tuple, optional): The wrapper commands, e.g. `\\mathrm`,
+        to remove. The contents of the wrappers are kept.
+
+    Returns:
+        str: The sanitised LaTeX string.
+    """
+    response = "".join(response.replace('~', ' ').split())
+    wrapper_re, wrapper_or_brace_re = _latex_wrapper_res(tuple(wrappers))
+    processed_response = []
+    index = 0
+    while (wrapper_match := wrapper_re.search(response, index)) is not None:
+        processed_response.append(response[index:wrapper_match.start()])
+        index = wrapper_match.end()
+        # Braces that belong to wrappers are removed, other braces are kept
+        is_wrapper_brace = [True]
+        for match in wrapper_or_brace_re.finditer(response, index):
+            token = match.group()
+            if token == "{":
+                is_wrapper_brace.append(False)
+            elif token == "}":
+                if is_wrapper_brace.pop():
+                    processed_response.append(response[index:match.start()])
+                    index = match.end()
+                if len(is_wrapper_brace) == 0:
+                    break
             else:
-                processed_response.append(response[index:])
-                index = len(response)
-        response = "".join(processed_response)
-    return response
+                processed_response.append(response[index:match.start()])
+                index = match.end()
+                is_wrapper_brace.append(True)
+    processed_response.append(response[index:])
+    return "".join(processed_response)
 
 def preview_function(response: Any, params: Params) -> Result:
     """
@@ -171,46 +229,271 @@ def preview_function(response: Any, params: Params) -> Result:
     split into many) is entirely up to you.
     """
 
-    response = sanitise_latex(response)
+    with preview_call("preview_function", response=response, params=params):
+        response = sanitise_latex(response)
 
-    symbols = params.get("symbols", {})
-    if params.get("is_latex", False):
-        if ',' in response:
-            responses = response.split(',')
-            resp_list = []
-            for resp in responses:
-                resp_list.append(parse_latex(resp, symbols))
-            response = ",".join(resp_list)
-        else:
-            response = parse_latex(response, symbols)
+        if params.get("is_latex", False):
+            # LaTeX that is too complex is rejected before it is parsed
+            check_complexity(check_expression_complexity, response, params)
+            response = latex_segments_to_sympy(response, params.get("symbols", {}))
 
-    if "substitutions" in params.keys() or params.get("comparison", "") == "buckinghamPi":
-        unsplittable_symbols = tuple()
-    else:
-        unsplittable_symbols = names_of_prefixes_units_and_dimensions
+        # Very long responses are rejected before they are preprocessed
+        check_complexity(check_expression_length, response, params)
+
+        parameters = preview_parameters(params)
+        response = normalise_response(response, parameters)
+        parsing_params = preview_parsing_params(parameters)
+
+        preview_latex, preview_sympy = render_preview(response, parameters, parsing_params)
+
+    return Result(preview=Preview(latex=preview_latex, sympy=preview_sympy))
+
+@contextmanager
+def preview_call(function_name, **arguments):
+    """Wraps a call of one of the preview functions.
+
+    Note:
+        Sympy's caches are trimmed before the call (see memory.py), slow
+        calls are captured with their arguments (see profiling.py) and the
+        outcome and duration of the call are added to the metrics (see
+        metrics.py).
+
+    Args:
+        function_name (str): Name of the preview function.
+        **arguments: The arguments of the call.
+    """
+    trim_caches_between_calls()
+    start = perf_counter() if metrics_enabled() else None
+    try:
+        with slow_call_capture(function_name, **arguments):
+            yield
+    except Exception:
+        count("previews", function=function_name, outcome="error")
+        raise
+    if start is not None:
+        count("previews", function=function_name, outcome="ok")
+        observe("preview_duration_seconds", perf_counter()-start, function=function_name)
+
+def latex_segments_to_sympy(response, symbols, cache=None):
+    """Parses each comma-separated segment of a sanitised LaTeX response.
 
+    Args:
+        response (str): Sanitised LaTeX response.
+        symbols (SymbolDict): A mapping of sympy symbol strings and LaTeX
+        symbol strings.
+        cache (dict, optional): Previously parsed segments, new segments are
+        added to it.
+
+    Returns:
+        str: The comma-separated segments in sympy syntax.
+    """
+    if cache is None:
+        cache = {}
+    resp_list = []
+    for resp in response.split(','):
+        if resp not in cache.keys():
+            cache[resp] = parse_latex(resp, symbols)
+        resp_list.append(cache[resp])
+    return ",".join(resp_list)
+
+def preview_parameters(params):
     parameters = {"comparison": "expression", "strict_syntax": True}
     parameters.update(params)
+    return parameters
 
+def normalise_response(response, parameters):
     response = preprocess_expression([response],parameters)[0]
-    parsing_params = create_sympy_parsing_params(parameters, unsplittable_symbols=unsplittable_symbols)
-    parsing_params.update({"comparison": parameters["comparison"]})
-
     if "per" not in sum([[x[0]]+x[1] for x in parameters.get("input_symbols",[])],[]):
         response = substitute(response+" ", convert_alternative_names_to_standard+[(" per ","/")])[0:-1]
+    return response
+
+def preview_parsing_params(parameters):
+    if "substitutions" in parameters.keys() or parameters["comparison"] == "buckinghamPi":
+        unsplittable_symbols = tuple()
+    else:
+        unsplittable_symbols = names_of_prefixes_units_and_dimensions
+    parsing_params = create_sympy_parsing_params(parameters, unsplittable_symbols=unsplittable_symbols)
+    return dict(parsing_params, comparison=parameters["comparison"])
 
+def check_complexity(check, response, params):
+    """Checks a response with one of the checks in complexity.py.
+
+    Args:
+        check (callable): check_expression_length or check_expression_complexity.
+        response (str): The response, as LaTeX or in sympy syntax.
+        params (Params): The parameters, with the complexity limits.
+
+    Raises:
+        ValueError: If the response is too complex to be parsed, with the
+        ExpressionTooComplex exception as cause.
+    """
+    try:
+        check(response.strip(), params)
+    except ExpressionTooComplex as exc:
+        raise ValueError(str(exc)) from exc
+
+def render_preview(response, parameters, parsing_params, cache=None):
+    """Computes the LaTeX and sympy strings for a normalised response.
+
+    Args:
+        response (str): Normalised response.
+        parameters (dict): Preview parameters.
+        parsing_params (dict): Parsing parameters for parse_expression.
+        cache (dict, optional): Previously rendered responses (or groups for
+        the buckinghamPi comparison), new ones are added to it.
+
+    Raises:
+        ValueError: If the response couldn't be parsed or is too complex
+        to be parsed (see complexity.py).
+
+    Returns:
+        tuple: The LaTeX string and the sympy string.
+    """
+    check_complexity(check_expression_complexity, response, parameters)
+    if cache is None:
+        cache = {}
     try:
         if parameters["comparison"] == "buckinghamPi":
             preview_latex = []
             response_strings = response.split(',')
             for current_response in response_strings:
-                latex, _ = expression_to_latex(current_response, parameters, parsing_params)
+                if current_response not in cache.keys():
+                    cache[current_response] = expression_to_latex(current_response, parameters, parsing_params)
+                latex, _ = cache[current_response]
                 preview_latex.append(latex)
             preview_latex = ",~".join(preview_latex)
             preview_sympy = response
         else:
-            preview_latex, preview_sympy = expression_to_latex(response, parameters, parsing_params)
+            if response not in cache.keys():
+                cache[response] = expression_to_latex(response, parameters, parsing_params)
+            preview_latex, preview_sympy = cache[response]
     except Exception as exc:
         raise ValueError("Cannot parse response") from exc
+    return preview_latex, preview_sympy
 
-    return Result(preview=Preview(latex=preview_latex, sympy=preview_sympy))
+class PreviewSession:
+    """Preview state that is shared between several responses previewed with the same parameters.
+
+    The parameters and parsing parameters are prepared once, and parsed LaTeX
+    segments and rendered responses (or groups for the buckinghamPi
+    comparison) are cached. If `keep_latest_only` is true only the work needed
+    for the latest response is kept, so that the memory used does not grow
+    while a response is being typed. Calls of `preview` on the same session
+    are serialised, so a session can be shared between threads.
+    """
+
+    def __init__(self, params, keep_latest_only=True):
+        self.params = params
+        self.keep_latest_only = keep_latest_only
+        self.parameters = None
+        self.parsing_params = None
+        self.latex_segments = {}
+        self.rendered = {}
+        self.last_input = None
+        self.last_preview = None
+        self._lock = threading.Lock()
+
+    def _reused(self, cache, keys):
+        if not self.keep_latest_only:
+            return cache
+        return {key: cache[key] for key in keys if key in cache.keys()}
+
+    def preview(self, response: Any) -> Result:
+        with self._lock:
+            return self._preview(response)
+
+    def _preview(self, response):
+        response = sanitise_latex(response)
+
+        if response == self.last_input:
+            preview_latex, preview_sympy = self.last_preview
+            return Result(preview=Preview(latex=preview_latex, sympy=preview_sympy))
+
+        normalised_response = response
+        if self.params.get("is_latex", False):
+            check_complexity(check_expression_complexity, response, self.params)
+            latex_segments = self._reused(self.latex_segments, response.split(','))
+            normalised_response = latex_segments_to_sympy(response, self.params.get("symbols", {}), cache=latex_segments)
+            self.latex_segments = latex_segments
+
+        check_complexity(check_expression_length, normalised_response, self.params)
+
+        if self.parameters is None:
+            parameters = preview_parameters(self.params)
+            normalised_response = normalise_response(normalised_response, parameters)
+            self.parameters = parameters
+            self.parsing_params = preview_parsing_params(parameters)
+        else:
+            normalised_response = normalise_response(normalised_response, self.parameters)
+
+        if self.parameters["comparison"] == "buckinghamPi":
+            rendered = self._reused(self.rendered, normalised_response.split(','))
+        else:
+            rendered = self._reused(self.rendered, [normalised_response])
+        preview_latex, preview_sympy = render_preview(normalised_response, self.parameters, self.parsing_params, cache=rendered)
+        self.rendered = rendered
+
+        self.last_input = response
+        self.last_preview = (preview_latex, preview_sympy)
+        return Result(preview=Preview(latex=preview_latex, sympy=preview_sympy))
+
+preview_sessions_max_size = 1024
+_preview_sessions = OrderedDict()
+_preview_sessions_lock = threading.Lock()
+
+def get_preview_session(session_key, params):
+    params_key = params_fingerprint(params)
+    with _preview_sessions_lock:
+        entry = _preview_sessions.get(session_key, None)
+        if entry is None or entry[0] != params_key:
+            entry = (params_key, PreviewSession(params))
+            _preview_sessions[session_key] = entry
+        _preview_sessions.move_to_end(session_key)
+        while len(_preview_sessions) > preview_sessions_max_size:
+            _preview_sessions.popitem(last=False)
+    return entry[1]
+
+def incremental_preview_function(response: Any, params: Params, session_key: Any) -> Result:
+    """
+    Function used to preview a student response while it is being typed.
+    ---
+    Gives the same result as preview_function, but the work done for the
+    previous response in the same session (identified by `session_key`)
+    is reused:
+
+    - If the sanitised response has not changed the previous preview is
+        returned without parsing or rendering anything.
+    - LaTeX segments (separated by commas) that are unchanged are not
+        parsed again.
+    - For the buckinghamPi comparison, groups that are unchanged are not
+        rendered again.
+
+    A session is reset when the parameters change. At most
+    `preview_sessions_max_size` sessions are kept, the least recently used
+    sessions are discarded first.
+    """
+    with preview_call("incremental_preview_function", response=response, params=params, session_key=session_key):
+        return get_preview_session(session_key, params).preview(response)
+
+def batch_preview_function(responses: List[Any], params: Params) -> List[Union[Result, ValueError]]:
+    """
+    Function used to preview many responses with the same parameters.
+    ---
+    Gives the same results as calling preview_function for each response,
+    but the parameters are prepared once and parsed LaTeX segments and
+    rendered responses (or groups for the buckinghamPi comparison) are
+    shared between all responses in the batch.
+
+    Responses that cannot be previewed do not stop the batch, the
+    ValueError that preview_function would have raised is returned in
+    their place instead.
+    """
+    with preview_call("batch_preview_function", responses=responses, params=params):
+        session = PreviewSession(params, keep_latest_only=False)
+        results = []
+        for response in responses:
+            try:
+                results.append(session.preview(response))
+            except ValueError as exc:
+                results.append(exc)
+    return results
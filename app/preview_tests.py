@@ -1,9 +1,10 @@
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 
 try:
-    from .preview import Params, preview_function
+    from .preview import Params, preview_function, incremental_preview_function, batch_preview_function, parse_latex, sanitise_latex, latex_symbol_substitutions
 except ImportError:
-    from preview import Params, preview_function
+    from preview import Params, preview_function, incremental_preview_function, batch_preview_function, parse_latex, sanitise_latex, latex_symbol_substitutions
 
 
 class TestPreviewFunction(unittest.TestCase):
@@ -68,5 +69,80 @@ class TestPreviewFunction(unittest.TestCase):
         result = preview_function(response, params)
         self.assertEqual(result["preview"]["latex"],"\\frac{L U}{\\nu},~\\frac{L f}{U}")
 
+    def test_latex_symbol_substitutions_are_cached_copies(self):
+        symbols = {
+            "rho": {"latex": r"\(\rho\)", "aliases": []},
+            "v": {"latex": r"\(v_0\)", "aliases": []},
+        }
+        substitutions = latex_symbol_substitutions(symbols)
+        substitutions.clear()
+        self.assertEqual(latex_symbol_substitutions(symbols), latex_symbol_substitutions(dict(symbols)))
+        self.assertEqual(len(latex_symbol_substitutions(symbols)), 2)
+        self.assertEqual(parse_latex(r"\rho v_0", symbols), "rho*v")
+
+    def test_incremental_preview_matches_preview(self):
+        params = {"comparison": "buckinghamPi",
+                  "quantities": "('U','(length/time)') ('L','(length)') ('nu','(length**2/time)') ('f','(1/time)')",
+                  "strict_syntax": False}
+        final_response = "U*L/nu, (f*L)/U"
+        for k in range(1, len(final_response)+1):
+            response = final_response[0:k]
+            try:
+                expected = preview_function(response, params)
+            except ValueError:
+                self.assertRaises(ValueError, incremental_preview_function, response, params, "session")
+                continue
+            result = incremental_preview_function(response, params, "session")
+            self.assertEqual(result, expected)
+        result = incremental_preview_function(final_response+" ", params, "session")
+        self.assertEqual(result["preview"]["latex"], "\\frac{L U}{\\nu},~\\frac{L f}{U}")
+
+    def test_incremental_preview_sessions_can_be_shared_between_threads(self):
+        params = {"strict_syntax": False}
+        responses = ["2 km/h", "x**2+y", "sin(x)", "3 m/s", "a*b/c"]*20
+        expected = {response: preview_function(response, params) for response in set(responses)}
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(lambda response: incremental_preview_function(response, params, "shared session"), responses))
+        for (response, result) in zip(responses, results):
+            self.assertEqual(result, expected[response])
+
+    def test_incremental_preview_resets_session_when_parameters_change(self):
+        response = "2 km/h"
+        result = incremental_preview_function(response, {"strict_syntax": False}, "session")
+        self.assertEqual(result["preview"]["latex"], "2 ~\\mathrm{kilo} ~\\mathrm{metre} ~\\mathrm{hour}^{-1}")
+        result = incremental_preview_function(response, {"strict_syntax": False, "comparison": "buckinghamPi"}, "session")
+        self.assertEqual(result, preview_function(response, {"strict_syntax": False, "comparison": "buckinghamPi"}))
+
+    def test_batch_preview_matches_preview(self):
+        params = {"comparison": "buckinghamPi",
+                  "quantities": "('U','(length/time)') ('L','(length)') ('nu','(length**2/time)') ('f','(1/time)')",
+                  "strict_syntax": False}
+        responses = ["U*L/nu, (f*L)/U", "U*L/nu", "(f*L)/U, U*L/nu", "U*L/nu, (f*L)/U", "U*L/nu, (f*L/U"]
+        results = batch_preview_function(responses, params)
+        self.assertEqual(len(results), len(responses))
+        for response, result in zip(responses[0:-1], results[0:-1]):
+            self.assertEqual(result, preview_function(response, params))
+        self.assertIsInstance(results[-1], ValueError)
+
+    def test_complex_response_is_rejected(self):
+        params = {"strict_syntax": False}
+        self.assertRaises(ValueError, preview_function, "10**10**10", params)
+        self.assertRaises(ValueError, preview_function, 60*"("+"x"+60*")", params)
+        self.assertRaises(ValueError, preview_function, 200000*"x", params)
+        self.assertRaises(ValueError, incremental_preview_function, 200000*"x", params, "session")
+        # LaTeX is checked before it is parsed
+        params = {"strict_syntax": False, "is_latex": True}
+        for response in ["+".join(10000*["x"]), "+".join(600*["x"]), 60*r"\left("+"x"+60*r"\right)"]:
+            self.assertRaises(ValueError, preview_function, response, params)
+            self.assertRaises(ValueError, incremental_preview_function, response, params, "latex session")
+
+    def test_sanitise_latex(self):
+        self.assertEqual(sanitise_latex(r"\mathrm{kg} ~ \text{m}/s^{2}"), "kgm/s^{2}")
+        self.assertEqual(sanitise_latex(r"\frac{\mathrm{m}}{\text {s}}"), r"\frac{m}{s}")
+        self.assertEqual(sanitise_latex(r"\mathrm{a\text{b{c}}d}e"), "ab{c}de")
+        self.assertEqual(sanitise_latex(r"\mathrm{abc"), "abc")
+        self.assertEqual(sanitise_latex(r"\textbf{x}"), r"\textbf{x}")
+        self.assertEqual(sanitise_latex(r"\textbf{x}", wrappers=(r"\textbf",)), "x")
+
 if __name__ == "__main__":
     unittest.main()
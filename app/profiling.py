@@ -0,0 +1,194 @@
+import argparse, copy, cProfile, json, os, pstats, sys, threading, time, uuid
+from time import perf_counter
+
+try:
+    from .memory import memory_report
+    from .timing import env_flag
+except ImportError:
+    from memory import memory_report
+    from timing import env_flag
+
+# -------- Capture of slow calls
+#
+# Calls of evaluation_function and the preview functions that take longer than a
+# threshold are captured together with their full inputs, stage timings and
+# memory use (see memory.py),
+# so that they can be replayed locally with
+#
+#     python -m app.profiling replay CAPTURED_FILE [CAPTURED_FILE ...] [--profile]
+#
+# Capturing is configured with configure_slow_call_capture or with the
+# environment variables below. Captured calls are written as JSON files to
+# the capture directory (if one is set) and passed to every hook registered
+# with add_slow_call_hook.
+
+capture_directory_environment_variable = "EVALUATION_CAPTURE_DIRECTORY"
+capture_threshold_environment_variable = "EVALUATION_CAPTURE_THRESHOLD"
+capture_cprofile_environment_variable = "EVALUATION_CAPTURE_CPROFILE"
+
+default_capture_threshold = 1.0
+
+_capture_settings = {
+    "directory": os.environ.get(capture_directory_environment_variable, "") or None,
+    "threshold": float(os.environ.get(capture_threshold_environment_variable, "") or default_capture_threshold),
+    "use_cprofile": env_flag(capture_cprofile_environment_variable),
+}
+_slow_call_hooks = []
+# cProfile can only profile one call at a time in a process
+_cprofile_lock = threading.Lock()
+
+def configure_slow_call_capture(directory=None, threshold=default_capture_threshold, use_cprofile=False):
+    '''
+    Input:
+        directory    : directory that captured calls are written to, or None
+                       to not write captured calls to files
+        threshold    : calls that take at least this many seconds are captured
+        use_cprofile : if true, calls are run with cProfile and the profile of
+                       captured calls is written next to the captured call.
+                       Note that this makes all calls slower, not just the
+                       captured ones.
+    '''
+    _capture_settings["directory"] = directory
+    _capture_settings["threshold"] = float(threshold)
+    _capture_settings["use_cprofile"] = use_cprofile
+
+def add_slow_call_hook(hook):
+    '''
+    Registers a function that is called with the record (a dictionary) of
+    every captured call.
+    '''
+    _slow_call_hooks.append(hook)
+
+def remove_slow_call_hook(hook):
+    _slow_call_hooks.remove(hook)
+
+def slow_call_capture_enabled():
+    return _capture_settings["directory"] is not None or len(_slow_call_hooks) > 0
+
+
+class SlowCallCapture:
+    '''
+    Context manager that measures the duration of a call and captures the
+    call if it took longer than the configured threshold. The caller can set
+    the `timings` attribute to add stage timings to the captured record.
+    '''
+
+    def __init__(self, function_name, arguments):
+        self.function_name = function_name
+        self.enabled = slow_call_capture_enabled()
+        # The arguments are copied since they might be changed during the call
+        self.arguments = copy.deepcopy(arguments) if self.enabled else arguments
+        self.timings = None
+        self._profile = None
+
+    def __enter__(self):
+        if self.enabled:
+            if _capture_settings["use_cprofile"] and _cprofile_lock.acquire(blocking=False):
+                self._profile = cProfile.Profile()
+                self._profile.enable()
+            self._start = perf_counter()
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        if not self.enabled:
+            return False
+        duration = perf_counter()-self._start
+        if self._profile is not None:
+            self._profile.disable()
+            _cprofile_lock.release()
+        if duration >= _capture_settings["threshold"]:
+            record = {
+                "function": self.function_name,
+                "arguments": self.arguments,
+                "duration": duration,
+                "timings": self.timings,
+                "memory": memory_report(),
+                "exception": None if exception is None else repr(exception),
+                "captured_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            }
+            self._write(record)
+            for hook in list(_slow_call_hooks):
+                hook(record)
+        return False
+
+    def _write(self, record):
+        directory = _capture_settings["directory"]
+        if directory is None:
+            return
+        os.makedirs(directory, exist_ok=True)
+        name = time.strftime("%Y%m%d-%H%M%S")+"-"+self.function_name+"-"+uuid.uuid4().hex[0:8]
+        path = os.path.join(directory, name)
+        if self._profile is not None:
+            self._profile.dump_stats(path+".prof")
+            record["profile"] = path+".prof"
+        with open(path+".json", "w") as file:
+            json.dump(record, file, indent=2, default=str)
+        record["path"] = path+".json"
+
+def slow_call_capture(function_name, **arguments):
+    return SlowCallCapture(function_name, arguments)
+
+# -------- Replay of captured calls
+
+def load_captured_call(path):
+    with open(path) as file:
+        return json.load(file)
+
+def captured_call_function(record):
+    try:
+        from .evaluation import evaluation_function
+        from .preview import preview_function, incremental_preview_function, batch_preview_function
+    except ImportError:
+        from evaluation import evaluation_function
+        from preview import preview_function, incremental_preview_function, batch_preview_function
+    functions = {
+        "evaluation_function": evaluation_function,
+        "preview_function": preview_function,
+        "incremental_preview_function": incremental_preview_function,
+        "batch_preview_function": batch_preview_function,
+    }
+    return functions[record["function"]]
+
+def replay_captured_call(record):
+    '''
+    Calls the function in a captured record with the captured arguments
+    and returns the result.
+    '''
+    return captured_call_function(record)(**record["arguments"])
+
+def replay(paths, repeat=1, profile=False, sort="cumulative", lines=30, out=sys.stdout):
+    for path in paths:
+        record = load_captured_call(path)
+        print(f"{path}: {record['function']} took {record['duration']:.3f} s when captured", file=out)
+        function = captured_call_function(record)
+        profiler = cProfile.Profile() if profile else None
+        for k in range(repeat):
+            start = perf_counter()
+            if profiler is not None:
+                profiler.enable()
+            try:
+                result = function(**record["arguments"])
+            except Exception as e:
+                result = repr(e)
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+            print(f"  run {k+1}: {perf_counter()-start:.3f} s, result: {json.dumps(result, default=str)}", file=out)
+        if profiler is not None:
+            pstats.Stats(profiler, stream=out).sort_stats(sort).print_stats(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tools for calls captured because they were slow.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    replay_parser = subparsers.add_parser("replay", help="re-run captured calls")
+    replay_parser.add_argument("paths", nargs="+", help="captured call files (.json)")
+    replay_parser.add_argument("--repeat", type=int, default=1, help="number of times each call is run")
+    replay_parser.add_argument("--profile", action="store_true", help="run the calls with cProfile and print the statistics")
+    replay_parser.add_argument("--sort", default="cumulative", help="sort order for the cProfile statistics")
+    replay_parser.add_argument("--lines", type=int, default=30, help="number of lines of cProfile statistics to print")
+    args = parser.parse_args(argv)
+    if args.command == "replay":
+        replay(args.paths, repeat=args.repeat, profile=args.profile, sort=args.sort, lines=args.lines)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+import argparse, json, sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from time import perf_counter
+
+try:
+    from .evaluation import evaluation_function
+    from .preview import preview_function
+    from .benchmark import latency_statistics
+except ImportError:
+    from evaluation import evaluation_function
+    from preview import preview_function
+    from benchmark import latency_statistics
+
+# -------- Request logs
+#
+# A request log is a JSONL file with one request per line, in the same form
+# as the payloads sent to the function:
+#
+#     {"command": "eval", "response": "2 km/h", "answer": "2*kilo*metre/hour", "params": {"strict_syntax": false}}
+#     {"command": "preview", "response": "2 km/h", "params": {"strict_syntax": false}}
+#
+# `command` is optional and defaults to "eval", `params` defaults to {}.
+# Empty lines are ignored. A log can be replayed to measure throughput with
+#
+#     python -m app.request_log replay LOG [--mode serial|threads|processes] [--workers N]
+
+request_commands = ("eval", "preview")
+
+def parse_request(line):
+    '''
+    Input:
+        line : a line from a request log
+    Output:
+        Dictionary with the keys `command`, `response`, `answer` (only for
+        eval requests) and `params`
+    '''
+    return normalise_request(json.loads(line))
+
+def normalise_request(request):
+    '''
+    Input:
+        request : a request, as a dictionary, in the request log format
+    Output:
+        Dictionary with the keys `command`, `response`, `answer` (only for
+        eval requests) and `params`
+    '''
+    if not isinstance(request, dict):
+        raise ValueError("Each line of a request log must be a JSON object.")
+    command = request.get("command", "eval")
+    if command not in request_commands:
+        raise ValueError(f"Unknown command {command}, must be one of: "+", ".join(request_commands))
+    parsed = {"command": command, "response": request.get("response", None), "params": request.get("params", {})}
+    if command == "eval":
+        parsed["answer"] = request.get("answer", None)
+    return parsed
+
+def read_request_log(file):
+    '''
+    Input:
+        file : file object or path of a request log
+    Output:
+        Generator that yields the requests in the log, in order
+    '''
+    if isinstance(file, str):
+        with open(file) as opened_file:
+            yield from read_request_log(opened_file)
+        return
+    for line in file:
+        if len(line.strip()) > 0:
+            yield parse_request(line)
+
+def write_request_log(requests, file):
+    for request in requests:
+        file.write(json.dumps(request, default=str)+"\n")
+
+def handle_request(request):
+    '''
+    Calls evaluation_function or preview_function, depending on the command
+    of the request, and returns the result.
+    '''
+    if request["command"] == "preview":
+        return preview_function(request["response"], request["params"])
+    return evaluation_function(request["response"], request["answer"], request["params"])
+
+def timed_request(request):
+    '''
+    Handles a request and returns the duration (in seconds) and the
+    exception that was raised as a string (None if no exception was raised).
+    '''
+    start = perf_counter()
+    try:
+        handle_request(request)
+        error = None
+    except Exception as e:
+        error = repr(e)
+    return perf_counter()-start, error
+
+def bounded_map(executor, function, iterable, window):
+    '''
+    Like executor.map, but only `window` calls are in flight at any time so
+    that long inputs are streamed rather than read into memory. Results are
+    yielded in input order.
+    '''
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(function, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while len(pending) > 0:
+        yield pending.popleft().result()
+
+def replay_requests(requests, mode="serial", workers=4):
+    '''
+    Input:
+        requests : iterable of requests (e.g. from read_request_log)
+        mode     : "serial", "threads" or "processes"
+        workers  : number of threads or processes (not used in serial mode)
+    Output:
+        Dictionary with the number of requests and errors, the error rate,
+        the wall-clock duration, the throughput in requests per second,
+        latency statistics and the number of requests for each command
+    '''
+    commands = {}
+
+    def counted(requests):
+        for request in requests:
+            commands[request["command"]] = commands.get(request["command"], 0)+1
+            yield request
+
+    start = perf_counter()
+    if mode == "serial":
+        outcomes = list(map(timed_request, counted(requests)))
+    elif mode in ("threads", "processes"):
+        executor_class = ThreadPoolExecutor if mode == "threads" else ProcessPoolExecutor
+        with executor_class(max_workers=workers) as executor:
+            outcomes = list(bounded_map(executor, timed_request, counted(requests), 4*workers))
+    else:
+        raise ValueError(f"Unknown mode {mode}, must be serial, threads or processes")
+    duration = perf_counter()-start
+
+    errors = {}
+    for (_, error) in outcomes:
+        if error is not None:
+            errors[error] = errors.get(error, 0)+1
+    number_of_errors = sum(errors.values())
+    return {
+        "mode": mode,
+        "workers": 1 if mode == "serial" else workers,
+        "requests": len(outcomes),
+        "commands": commands,
+        "errors": number_of_errors,
+        "error_rate": number_of_errors/len(outcomes) if len(outcomes) > 0 else 0.0,
+        "most_common_errors": sorted(errors.items(), key=lambda x: -x[1])[0:10],
+        "duration": duration,
+        "requests_per_second": len(outcomes)/duration if duration > 0 else None,
+        "latency": latency_statistics([seconds for (seconds, _) in outcomes]) if len(outcomes) > 0 else None,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tools for JSONL request logs.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    replay_parser = subparsers.add_parser("replay", help="replay a request log and report throughput and latency")
+    replay_parser.add_argument("log", help="request log, - for stdin")
+    replay_parser.add_argument("--mode", choices=["serial", "threads", "processes"], default="serial")
+    replay_parser.add_argument("--workers", type=int, default=4, help="number of threads or processes")
+    replay_parser.add_argument("--repeat", type=int, default=1, help="number of times the log is replayed")
+    replay_parser.add_argument("--output", help="write the report to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    if args.command == "replay":
+        if args.log == "-":
+            if args.repeat != 1:
+                parser.error("--repeat can not be used when the log is read from stdin")
+            requests = read_request_log(sys.stdin)
+        else:
+            requests = (request for _ in range(args.repeat) for request in read_request_log(args.log))
+        report = replay_requests(requests, mode=args.mode, workers=args.workers)
+        if args.output is not None:
+            with open(args.output, "w") as file:
+                json.dump(report, file, indent=2)
+        else:
+            json.dump(report, sys.stdout, indent=2)
+            print()
+
+if __name__ == "__main__":
+    main()
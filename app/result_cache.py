@@ -0,0 +1,238 @@
+import contextlib, hashlib, importlib.metadata, importlib.util, json, os, sqlite3, threading, time
+
+import sympy
+
+try:
+    from .expression_utilities import params_fingerprint
+except ImportError:
+    from expression_utilities import params_fingerprint
+
+# -------- Persistent result cache
+#
+# Results of evaluation_function can be stored in a SQLite database that is
+# shared by all processes on a machine, so that identical submissions are
+# only graded once. The cache is enabled with configure_result_cache or by
+# setting the environment variable EVALUATION_RESULT_CACHE to the path of
+# the database file. Entries are keyed by a hash of the response, answer,
+# fingerprint of params (see params_fingerprint) and cache_version (which
+# changes whenever the code of the package or the version of one of the
+# packages it uses to compute results changes, so results from older
+# versions are never used). When the total size of the stored results
+# exceeds the maximum size the least recently used entries are removed (the
+# time of last use is only updated once every last_used_resolution seconds).
+
+result_cache_environment_variable = "EVALUATION_RESULT_CACHE"
+result_cache_max_size_environment_variable = "EVALUATION_RESULT_CACHE_MAX_SIZE"
+
+default_result_cache_max_size = 256*1024*1024
+
+# Source files that affect the results, all other files in the package are tools
+result_cache_source_files = (
+    "complexity.py",
+    "evaluation.py",
+    "expression_parser.py",
+    "expression_utilities.py",
+    "preview.py",
+    "static_unit_conversion_arrays.py",
+)
+
+# Installed packages that affect the results
+result_cache_packages = ("sympy", "mpmath", "latex2sympy2", "antlr4-python3-runtime")
+# latex2sympy is installed from git without changing its version, so its source is hashed as well
+result_cache_hashed_modules = ("latex2sympy2",)
+
+def package_version(name):
+    try:
+        return importlib.metadata.version(name)
+    except importlib.metadata.PackageNotFoundError:
+        return "not installed"
+
+def module_hash(name):
+    spec = importlib.util.find_spec(name)
+    if spec is None or spec.origin is None or not os.path.isfile(spec.origin):
+        return "not found"
+    with open(spec.origin, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+def compute_cache_version():
+    digest = hashlib.sha256(sympy.__version__.encode())
+    for name in result_cache_packages:
+        digest.update(f"{name}=={package_version(name)}\n".encode())
+    for name in result_cache_hashed_modules:
+        digest.update(module_hash(name).encode())
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for name in result_cache_source_files:
+        with open(os.path.join(directory, name), "rb") as file:
+            digest.update(file.read())
+    return digest.hexdigest()[0:16]
+
+cache_version = compute_cache_version()
+
+def result_cache_key(response, answer, params):
+    '''
+    Input:
+        response, answer, params : arguments of evaluation_function
+    Output:
+        String that is the same for calls of evaluation_function that
+        give the same result with the current version of the package
+    '''
+    if isinstance(response, str):
+        response = response.strip()
+    if isinstance(answer, str):
+        answer = answer.strip()
+    key = json.dumps([cache_version, response, answer, params_fingerprint(params)], sort_keys=True, default=str)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+def result_cacheable(params):
+    '''
+    Returns False for calls where the result is not a plain dictionary
+    (lazy LaTeX generation), these results are not cached.
+    '''
+    return params.get("generate_response_latex", True) != "lazy"
+
+
+class ResultCache:
+    '''
+    Input:
+        path     : path of the SQLite database file, it is created if it does not exist
+        max_size : maximum total size (in bytes) of the stored results
+
+    The cache can be used from several threads and processes at the same time.
+    Each thread (in each process) uses its own connection to the database.
+    '''
+
+    # Number of insertions between checks of the total size
+    eviction_interval = 100
+    # Seconds before the last use of an entry is updated again, so that cache
+    # hits only need to write to the database once in a while
+    last_used_resolution = 60
+
+    def __init__(self, path, max_size=default_result_cache_max_size):
+        self.path = path
+        self.max_size = max_size
+        self._local = threading.local()
+        self._insertions = 0
+        self._insertions_lock = threading.Lock()
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+
+    def _connection(self):
+        # Connections must not be shared between threads, or used in a forked process
+        if getattr(self._local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def get(self, key):
+        '''
+        Returns the stored result for the key, or None if there is no stored result.
+        '''
+        connection = self._connection()
+        row = connection.execute("SELECT value, last_used FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if now-row[1] > self.last_used_resolution:
+            connection.execute("UPDATE results SET last_used = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def put(self, key, result):
+        try:
+            value = json.dumps(result)
+        except TypeError:
+            # Results that are not JSON-encodable are not cached
+            return
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO results (key, value, size, last_used) VALUES (?, ?, ?, ?)",
+            (key, value, len(key)+len(value), time.time())
+        )
+        # The cache is shared by the threads of the grading server and the batch tools
+        with self._insertions_lock:
+            self._insertions += 1
+            evict = self._insertions % self.eviction_interval == 0
+        if evict:
+            self.evict()
+
+    def size(self):
+        return self._connection().execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def evict(self):
+        '''
+        Removes the least recently used results until the total size is at
+        most 90% of the maximum size (if it is above the maximum size).
+        '''
+        connection = self._connection()
+        size = self.size()
+        if size <= self.max_size:
+            return
+        target = 0.9*self.max_size
+        with connection:
+            rows = connection.execute("SELECT key, size FROM results ORDER BY last_used")
+            to_remove = []
+            for (key, entry_size) in rows:
+                if size <= target:
+                    break
+                to_remove.append((key,))
+                size -= entry_size
+            connection.executemany("DELETE FROM results WHERE key = ?", to_remove)
+
+    def clear(self):
+        self._connection().execute("DELETE FROM results")
+
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+_result_cache_configured = False
+
+def configure_result_cache(path=None, max_size=default_result_cache_max_size):
+    '''
+    Enables the result cache, stored in the database file at path, or
+    disables it if path is None.
+    '''
+    global _result_cache, _result_cache_configured
+    with _result_cache_lock:
+        _result_cache = None if path is None else ResultCache(path, max_size)
+        _result_cache_configured = True
+
+@contextlib.contextmanager
+def result_cache_disabled():
+    '''
+    Disables the result cache in this process while the block runs, without
+    changing the stored results, and then restores the previous configuration.
+    '''
+    global _result_cache, _result_cache_configured
+    previous = get_result_cache()
+    with _result_cache_lock:
+        _result_cache = None
+        _result_cache_configured = True
+    try:
+        yield
+    finally:
+        with _result_cache_lock:
+            _result_cache = previous
+
+def get_result_cache():
+    '''
+    Returns the configured ResultCache, or None if the cache is not enabled.
+    '''
+    global _result_cache, _result_cache_configured
+    if not _result_cache_configured:
+        with _result_cache_lock:
+            if not _result_cache_configured:
+                path = os.environ.get(result_cache_environment_variable, "") or None
+                max_size = int(os.environ.get(result_cache_max_size_environment_variable, "") or default_result_cache_max_size)
+                _result_cache = None if path is None else ResultCache(path, max_size)
+                _result_cache_configured = True
+    return _result_cache
@@ -0,0 +1,234 @@
+import argparse, asyncio, json, os
+from concurrent.futures import ProcessPoolExecutor
+from http import HTTPStatus
+from time import perf_counter
+
+try:
+    from .request_log import normalise_request, handle_request, request_commands
+    from .metrics import metrics, metrics_environment_variable, configure_metrics, metrics_enabled, count, observe, drain_metrics
+except ImportError:
+    from request_log import normalise_request, handle_request, request_commands
+    from metrics import metrics, metrics_environment_variable, configure_metrics, metrics_enabled, count, observe, drain_metrics
+
+# -------- Local grading server
+#
+# A long-running HTTP server, using only asyncio from the standard library,
+# for running the function on our own machines. Requests are handled by a
+# pool of worker processes that are started and warmed up (modules imported
+# and caches filled) when the server starts and then kept alive, so requests
+# do not pay start-up costs and caches stay warm between requests.
+#
+#     python -m app.server [--host HOST] [--port PORT] [--workers N]
+#
+# Requests are POST requests with a JSON body in the same form as the
+# payloads sent to the deployed function, {"response": ..., "answer": ...,
+# "params": ...}. The command is given by the path (/eval or /preview) or,
+# as for the deployed function, by a `command` header on requests to /.
+# The response body is {"command": ..., "result": ...} or, if the request
+# could not be handled, {"error": {"message": ...}}. GET /health can be
+# used to check that the server is running.
+#
+# With --metrics (or the environment variable EVALUATION_METRICS, see
+# metrics.py) the metrics of the server and all its workers are collected,
+# GET /metrics returns them in the Prometheus text format and GET
+# /metrics.json as JSON.
+
+max_body_size = 1024*1024
+
+warm_up_requests = [
+    {"command": "eval", "response": "2 km/h", "answer": "2*kilo*metre/hour", "params": {"strict_syntax": False}},
+    {"command": "eval", "response": "sin(x)^2+cos(x)^2", "answer": "1", "params": {"strict_syntax": False, "elementary_functions": True}},
+    {"command": "preview", "response": "2 km/h", "params": {"strict_syntax": False}},
+]
+
+def warm_up():
+    '''
+    Handles some typical requests so that modules are imported and caches
+    are filled before the first real request. Returns the process id.
+    '''
+    for request in warm_up_requests:
+        handle_request(request)
+    # Warm-up requests are not included in the metrics
+    drain_metrics()
+    return os.getpid()
+
+def handle_request_in_worker(request):
+    '''
+    Returns the result and the metrics collected in the worker since the
+    last request (None if metrics are not enabled), the metrics are added
+    to the metrics of the server process.
+    '''
+    # Results with deferred entries (see EvaluationResult) cannot be sent
+    # between processes, so only the computed entries are returned
+    result = dict(handle_request(request))
+    return result, drain_metrics()
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class GradingServer:
+    '''
+    Input:
+        host     : address to listen on
+        port     : port to listen on, 0 picks a free port (see the `port` attribute after start)
+        workers  : number of worker processes
+        executor : executor used instead of a process pool (e.g. a thread pool for testing)
+    '''
+
+    def __init__(self, host="127.0.0.1", port=8080, workers=None, executor=None):
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = executor
+        self._server = None
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        if self.executor is None:
+            # Each worker process is warmed up when it starts, submitting one task per
+            # worker makes sure that all of them have started before requests arrive
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=warm_up)
+            await asyncio.gather(*[loop.run_in_executor(self.executor, os.getpid) for _ in range(self.workers)])
+        else:
+            await loop.run_in_executor(self.executor, warm_up)
+        self._server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self):
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                keep_alive = False
+                try:
+                    request_line = await self.read_line(reader)
+                    if len(request_line) == 0:
+                        break
+                    method, path, version, headers, body = await self.read_request(request_line, reader)
+                    keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                    status, payload = await self.dispatch(method, path, headers, body)
+                except HTTPError as e:
+                    count("server_errors", status=e.status.value)
+                    status, payload = e.status, {"error": {"message": str(e)}}
+                self.write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def read_line(self, reader):
+        try:
+            return await reader.readline()
+        except (asyncio.LimitOverrunError, ValueError):
+            # The rest of the line is not read, so the connection is closed after the response
+            raise HTTPError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, "Request line or header is too long.")
+
+    async def read_request(self, request_line, reader):
+        parts = request_line.decode("latin-1").split()
+        if len(parts) != 3:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Malformed request line.")
+        method, path, version = parts
+        headers = {}
+        while True:
+            line = await self.read_line(reader)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get("content-length", "0"))
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Invalid Content-Length.")
+        if length > max_body_size:
+            raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "Request body is too large.")
+        body = await reader.readexactly(length)
+        return method, path.split("?")[0], version, headers, body
+
+    async def dispatch(self, method, path, headers, body):
+        if path == "/health":
+            return HTTPStatus.OK, {"status": "ok"}
+        if path in ("/metrics", "/metrics.json"):
+            if not metrics_enabled():
+                raise HTTPError(HTTPStatus.NOT_FOUND, "Metrics are not enabled, start the server with --metrics.")
+            return HTTPStatus.OK, metrics.to_prometheus() if path == "/metrics" else metrics.snapshot()
+        if method != "POST":
+            raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED, "Only POST requests are supported.")
+        command = path.strip("/") or headers.get("command", "eval")
+        if command not in request_commands:
+            raise HTTPError(HTTPStatus.NOT_FOUND, f"Unknown command {command}, must be one of: "+", ".join(request_commands))
+        try:
+            request = normalise_request({**json.loads(body or b"{}"), "command": command})
+        except (ValueError, TypeError) as e:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Request body must be a JSON object: "+str(e))
+        loop = asyncio.get_running_loop()
+        start = perf_counter()
+        try:
+            result, worker_metrics = await loop.run_in_executor(self.executor, handle_request_in_worker, request)
+        except Exception as e:
+            count("server_requests", command=command, status=HTTPStatus.INTERNAL_SERVER_ERROR.value)
+            return HTTPStatus.INTERNAL_SERVER_ERROR, {"error": {"message": str(e) or repr(e)}}
+        if worker_metrics is not None:
+            metrics.merge(worker_metrics)
+        count("server_requests", command=command, status=HTTPStatus.OK.value)
+        observe("server_request_duration_seconds", perf_counter()-start, command=command)
+        return HTTPStatus.OK, {"command": command, "result": result}
+
+    def write_response(self, writer, status, payload, keep_alive):
+        # Payloads are JSON, except the metrics in the Prometheus text format
+        if isinstance(payload, str):
+            body = payload.encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            body = json.dumps(payload, default=str).encode("utf-8")
+            content_type = "application/json"
+        head = [
+            f"HTTP/1.1 {status.value} {status.phrase}",
+            "Content-Type: "+content_type,
+            f"Content-Length: {len(body)}",
+            "Connection: "+("keep-alive" if keep_alive else "close"),
+        ]
+        writer.write(("\r\n".join(head)+"\r\n\r\n").encode("latin-1")+body)
+
+async def serve(host, port, workers):
+    server = GradingServer(host, port, workers)
+    await server.start()
+    print(f"Serving on http://{server.host}:{server.port} with {server.workers} workers", flush=True)
+    try:
+        await server.serve_forever()
+    finally:
+        await server.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a local grading server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--metrics", action="store_true", help="collect metrics and serve them on /metrics")
+    args = parser.parse_args(argv)
+    if args.metrics:
+        # Worker processes read the environment variable when they start
+        os.environ[metrics_environment_variable] = "1"
+        configure_metrics(True)
+    try:
+        asyncio.run(serve(args.host, args.port, args.workers))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
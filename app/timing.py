@@ -0,0 +1,160 @@
+import os, threading
+from time import perf_counter
+
+# -------- Per-stage timing of evaluations
+#
+# Timings are collected when the `timings` parameter is true or when the
+# environment variable EVALUATION_TIMINGS is set to something other than
+# "", "0" or "false". Collected timings are added to in-process histograms
+# that can be read with get_timing_histograms. Only when the `timings`
+# parameter is true the result of the evaluation also has a `timings` entry
+# with the time (in seconds) spent in each stage, the environment variable
+# does not change the results.
+
+timings_environment_variable = "EVALUATION_TIMINGS"
+
+# Upper bounds, in seconds, of the histogram buckets
+timing_histogram_bounds = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def env_flag(name):
+    '''
+    Returns True if the environment variable is set to something other than
+    "", "0" or "false" (ignoring case and surrounding whitespace). Used for all
+    the environment variables that turn instrumentation on.
+    '''
+    return os.environ.get(name, "").strip().lower() not in ("", "0", "false")
+
+def timings_enabled(params):
+    '''
+    Input:
+        params : evaluation function parameter dictionary
+    Output:
+        True if stage timings should be collected, otherwise False
+    '''
+    if params.get("timings", False):
+        return True
+    return env_flag(timings_environment_variable)
+
+def timings_requested(params):
+    '''
+    Returns True if the timings should be added to the result, i.e. if the `timings` parameter is true.
+    '''
+    return bool(params.get("timings", False))
+
+
+class StageTimer:
+    '''
+    Measures how much time is spent in each stage of a computation.
+
+    Calling start(stage) ends the stage that is currently running (if any)
+    and starts timing the given stage, stop() ends the current stage. Time
+    spent in the same stage several times is added up. When the timer is
+    not enabled all methods return immediately.
+    '''
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.timings = {}
+        self._stage = None
+        self._stage_start = None
+        self._start = perf_counter() if enabled else None
+
+    def start(self, stage):
+        if not self.enabled:
+            return
+        now = perf_counter()
+        self._end_stage(now)
+        self._stage = stage
+        self._stage_start = now
+
+    def stop(self):
+        if not self.enabled:
+            return
+        self._end_stage(perf_counter())
+        self._stage = None
+
+    def _end_stage(self, now):
+        if self._stage is not None:
+            self.timings[self._stage] = self.timings.get(self._stage, 0.0)+now-self._stage_start
+
+    def result(self):
+        '''
+        Stops the timer and returns a dictionary with the time spent in
+        each stage and the total time since the timer was created.
+        '''
+        self.stop()
+        timings = dict(self.timings)
+        timings["total"] = perf_counter()-self._start
+        return timings
+
+
+class TimingHistogram:
+    '''
+    Histogram of durations with the buckets given by timing_histogram_bounds
+    (the last bucket contains everything above the largest bound).
+    '''
+
+    def __init__(self, bounds=timing_histogram_bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0]*(len(self.bounds)+1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        index = 0
+        while index < len(self.bounds) and seconds > self.bounds[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, data):
+        '''
+        Adds the counts of a histogram with the same bounds, in the form returned by to_dict.
+        '''
+        if tuple(data["bounds"]) != self.bounds:
+            raise ValueError("Histograms with different bounds cannot be merged.")
+        self.counts = [a+b for (a, b) in zip(self.counts, data["counts"])]
+        self.count += data["count"]
+        self.sum += data["sum"]
+        self.max = max(self.max, data["max"])
+
+    def to_dict(self):
+        return {
+            "bounds": list(self.bounds),
+            "counts": list(self.counts),
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+        }
+
+
+_timing_histograms = {}
+_timing_histograms_lock = threading.Lock()
+
+def record_timings(timings):
+    '''
+    Adds a dictionary of stage timings to the in-process histograms.
+    '''
+    with _timing_histograms_lock:
+        for (stage, seconds) in timings.items():
+            histogram = _timing_histograms.get(stage, None)
+            if histogram is None:
+                histogram = TimingHistogram()
+                _timing_histograms[stage] = histogram
+            histogram.observe(seconds)
+
+def get_timing_histograms():
+    '''
+    Output:
+        Dictionary with a snapshot of the histogram for each stage, in the
+        form returned by TimingHistogram.to_dict
+    '''
+    with _timing_histograms_lock:
+        return {stage: histogram.to_dict() for (stage, histogram) in _timing_histograms.items()}
+
+def reset_timing_histograms():
+    with _timing_histograms_lock:
+        _timing_histograms.clear()
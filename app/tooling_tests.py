@@ -0,0 +1,313 @@
+import asyncio, io, json, os, unittest, tempfile, urllib.error, urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from .evaluation import evaluation_function, parsing_feedback_responses
+    from .preview import incremental_preview_function, batch_preview_function
+    from .timing import get_timing_histograms, reset_timing_histograms, env_flag
+    from .benchmark import run_benchmark
+    from .request_log import read_request_log, parse_request, replay_requests
+    from .grade import grade_lines
+    from .server import GradingServer
+    from .result_cache import ResultCache, configure_result_cache, get_result_cache, result_cache_key
+    from .memory import configure_cache_trimming, trim_caches_between_calls, sympy_cache_entries, memory_check_interval
+    from .metrics import metrics, configure_metrics, write_metrics
+    from .profiling import configure_slow_call_capture, add_slow_call_hook, remove_slow_call_hook, load_captured_call, replay_captured_call
+except ImportError:
+    from evaluation import evaluation_function, parsing_feedback_responses
+    from preview import incremental_preview_function, batch_preview_function
+    from timing import get_timing_histograms, reset_timing_histograms, env_flag
+    from benchmark import run_benchmark
+    from request_log import read_request_log, parse_request, replay_requests
+    from grade import grade_lines
+    from server import GradingServer
+    from result_cache import ResultCache, configure_result_cache, get_result_cache, result_cache_key
+    from memory import configure_cache_trimming, trim_caches_between_calls, sympy_cache_entries, memory_check_interval
+    from metrics import metrics, configure_metrics, write_metrics
+    from profiling import configure_slow_call_capture, add_slow_call_hook, remove_slow_call_hook, load_captured_call, replay_captured_call
+
+# Tests of the tools used to run and monitor the evaluation function, the
+# grading itself is tested in evaluation_tests.py and preview_tests.py
+parse_error_warning = parsing_feedback_responses["PARSE_ERROR_WARNING"]
+
+
+class TestTimingsAndProfiling(unittest.TestCase):
+    """
+    Tests of the stage timings, slow call capture, metrics and memory management.
+    """
+
+    def test_timings(self):
+        params = {"strict_syntax": False}
+        result = evaluation_function("2 km/h", "2*kilo*metre/hour", params)
+        self.assertEqual("timings" in result, False)
+        reset_timing_histograms()
+        params = {"strict_syntax": False, "timings": True}
+        result = evaluation_function("2 km/h", "2*kilo*metre/hour", params)
+        self.assertEqual(result["is_correct"], True)
+        timings = result["timings"]
+        for stage in ["substitute", "preprocess_expression", "expression_to_latex", "parse_expression", "comparison", "total"]:
+            self.assertEqual(stage in timings, True)
+        self.assertLessEqual(sum(t for (stage, t) in timings.items() if stage != "total"), timings["total"])
+        histograms = get_timing_histograms()
+        self.assertEqual(histograms["total"]["count"], 1)
+        self.assertGreater(result["memory"]["rss"], 0)
+        self.assertGreater(result["memory"]["sympy_cache_entries"], 0)
+        self.assertEqual(sum(histograms["parse_expression"]["counts"]), 1)
+        # Timings enabled with the environment variable are only added to the histograms
+        os.environ["EVALUATION_TIMINGS"] = "1"
+        try:
+            result = evaluation_function("2 km/h", "2*kilo*metre/hour", {"strict_syntax": False})
+            for (value, enabled) in [("1", True), ("yes", True), ("0", False), (" False ", False), ("", False)]:
+                os.environ["EVALUATION_TIMINGS"] = value
+                self.assertEqual(env_flag("EVALUATION_TIMINGS"), enabled)
+        finally:
+            del os.environ["EVALUATION_TIMINGS"]
+        self.assertEqual(env_flag("EVALUATION_TIMINGS"), False)
+        self.assertEqual(result, {"is_correct": True, "comparison": "expression", "response_latex": result["response_latex"]})
+        self.assertEqual(get_timing_histograms()["total"]["count"], 2)
+
+    def test_slow_calls_are_captured_and_can_be_replayed(self):
+        captured = []
+        with tempfile.TemporaryDirectory() as directory:
+            configure_slow_call_capture(directory=directory, threshold=0)
+            add_slow_call_hook(captured.append)
+            try:
+                params = {"strict_syntax": False}
+                result = evaluation_function("2 km/h", "2*kilo*metre/hour", params)
+                previews = batch_preview_function(["2 km/h", "x"], params)
+                with self.assertRaises(Exception):
+                    evaluation_function("x", "x^", {"strict_syntax": True})
+            finally:
+                remove_slow_call_hook(captured.append)
+                configure_slow_call_capture(directory=None)
+            self.assertEqual(len(captured), 3)
+            record = load_captured_call(captured[0]["path"])
+            self.assertEqual(record["arguments"], {"response": "2 km/h", "answer": "2*kilo*metre/hour", "params": params})
+            self.assertEqual("parse_expression" in record["timings"], True)
+            self.assertEqual(replay_captured_call(record), result)
+            record = load_captured_call(captured[1]["path"])
+            self.assertEqual(record["function"], "batch_preview_function")
+            self.assertEqual(replay_captured_call(record), previews)
+            # Calls that fail are captured with the timings up to the failure
+            record = load_captured_call(captured[2]["path"])
+            self.assertNotEqual(record["exception"], None)
+            self.assertEqual("preprocess_expression" in record["timings"], True)
+            self.assertGreater(record["timings"]["total"], 0)
+        self.assertEqual("timings" in result, False)
+
+    def test_metrics(self):
+        params = {"strict_syntax": False}
+        counters = lambda: {(c["name"], tuple(sorted(c["labels"].items()))): c["value"] for c in metrics.snapshot()["counters"]}
+        metrics.reset()
+        evaluation_function("2 km/h", "2*kilo*metre/hour", params)
+        self.assertEqual(metrics.snapshot(), {"counters": [], "histograms": []})
+        configure_metrics(True)
+        try:
+            evaluation_function("2 km/h", "2*kilo*metre/hour", params)
+            evaluation_function("3 km/h", "2*kilo*metre/hour", params)
+            evaluation_function("x+", "x", params)
+            evaluation_function("10**10**10", "x", params)
+            with self.assertRaises(Exception):
+                evaluation_function("x", "", params)
+            incremental_preview_function("x", params, "metrics")
+            batch_preview_function(["x", "x+"], params)
+            counts = counters()
+            self.assertEqual(counts[("previews", (("function", "incremental_preview_function"), ("outcome", "ok")))], 1)
+            self.assertEqual(counts[("previews", (("function", "batch_preview_function"), ("outcome", "ok")))], 1)
+            self.assertEqual(counts[("evaluations", (("comparison", "expression"), ("outcome", "correct")))], 1)
+            self.assertEqual(counts[("evaluations", (("comparison", "expression"), ("outcome", "incorrect")))], 1)
+            self.assertEqual(counts[("evaluations", (("comparison", "expression"), ("outcome", "too_complex")))], 1)
+            self.assertEqual(counts[("evaluations", (("comparison", "expression"), ("outcome", "parse_error")))], 1)
+            self.assertEqual(counts[("evaluations", (("comparison", "expression"), ("outcome", "error")))], 1)
+            self.assertEqual(counts[("rejected_responses", (("measure", "max_exponent"),))], 1)
+            self.assertGreater(counts[("parsed_expressions", (("parser", "native"),))], 0)
+            histograms = {(h["name"], h["labels"]["stage"]): h for h in metrics.snapshot()["histograms"] if h["name"] == "evaluation_stage_duration_seconds"}
+            self.assertEqual(histograms[("evaluation_stage_duration_seconds", "total")]["count"], 4)
+            self.assertIn("parse_expression", [stage for (_, stage) in histograms.keys()])
+            previews = [h for h in metrics.snapshot()["histograms"] if h["name"] == "preview_duration_seconds"]
+            self.assertEqual(sorted(h["labels"]["function"] for h in previews), ["batch_preview_function", "incremental_preview_function"])
+            text = metrics.to_prometheus()
+            self.assertIn('evaluations_total{comparison="expression",outcome="correct"} 1\n', text)
+            self.assertIn('evaluation_stage_duration_seconds_bucket{comparison="expression",le="+Inf",stage="total"} 4\n', text)
+            self.assertIn('evaluation_stage_duration_seconds_count{comparison="expression",stage="total"} 4\n', text)
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, "metrics-{pid}.json")
+                write_metrics(path)
+                with open(path.replace("{pid}", str(os.getpid()))) as file:
+                    snapshot = json.load(file)
+            self.assertEqual(snapshot, metrics.snapshot())
+            metrics.merge(snapshot)
+            self.assertEqual(counters()[("evaluations", (("comparison", "expression"), ("outcome", "correct")))], 2)
+        finally:
+            configure_metrics(False)
+            metrics.reset()
+
+    def test_sympy_cache_trimming(self):
+        params = {"strict_syntax": False}
+        try:
+            self.assertEqual(trim_caches_between_calls(), False)
+            configure_cache_trimming(interval=2)
+            evaluation_function("2 km/h", "2*kilo*metre/hour", params)
+            self.assertGreater(sympy_cache_entries(), 0)
+            self.assertEqual(trim_caches_between_calls(), True)
+            self.assertEqual(sympy_cache_entries(), 0)
+            configure_cache_trimming(memory_limit=1)
+            self.assertEqual([trim_caches_between_calls() for _ in range(memory_check_interval)][-2:], [False, True])
+        finally:
+            configure_cache_trimming()
+
+
+class TestRequestTools(unittest.TestCase):
+    """
+    Tests of the tools that run many requests: the benchmark, request log replay, batch grading and the local grading server.
+    """
+
+    def test_benchmark(self):
+        corpus = [
+            {"response": "2 km/h", "answer": "2*kilo*metre/hour", "params": {"strict_syntax": False}},
+            {"response": "U*L/nu", "answer": "U*L/nu", "params": {"comparison": "buckinghamPi"}},
+            {"response": "x", "answer": "", "params": {}},
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            configure_result_cache(os.path.join(directory, "results.db"))
+            try:
+                cache = get_result_cache()
+                results = run_benchmark(corpus, repeat=2)
+                # The result cache is not used by the benchmark
+                self.assertEqual(len(cache), 0)
+                self.assertIs(get_result_cache(), cache)
+            finally:
+                configure_result_cache(None)
+        self.assertEqual(len(results["cases"]), 3)
+        self.assertEqual(results["cases"][2]["error"] is not None, True)
+        self.assertEqual(results["summary"]["all"]["cases"], 3)
+        self.assertEqual(results["summary"]["all"]["errors"], 1)
+        self.assertEqual(results["summary"]["buckinghamPi"]["warm"]["count"], 1)
+        self.assertEqual(results["summary"]["expression"]["cases"], 2)
+
+    def test_replay_request_log(self):
+        log = io.StringIO(
+            '{"command": "eval", "response": "2 km/h", "answer": "2*kilo*metre/hour", "params": {"strict_syntax": false}}\n'
+            '\n'
+            '{"response": "x", "answer": ""}\n'
+            '{"command": "preview", "response": "2 km/h", "params": {"strict_syntax": false}}\n'
+        )
+        requests = list(read_request_log(log))
+        self.assertEqual([request["command"] for request in requests], ["eval", "eval", "preview"])
+        self.assertRaises(ValueError, parse_request, '{"command": "grade"}')
+        for mode in ["serial", "threads"]:
+            with self.subTest(mode=mode):
+                report = replay_requests(requests, mode=mode, workers=2)
+                self.assertEqual(report["requests"], 3)
+                self.assertEqual(report["commands"], {"eval": 2, "preview": 1})
+                self.assertEqual(report["errors"], 1)
+                self.assertAlmostEqual(report["error_rate"], 1/3)
+                self.assertEqual(report["latency"]["count"], 3)
+
+    def test_grade_lines(self):
+        lines = [
+            '{"id": 1, "response": "2 km/h", "answer": "2*kilo*metre/hour", "params": {"strict_syntax": false}}',
+            '',
+            'not a request',
+            '{"id": 3, "response": "x", "answer": ""}',
+            '{"id": 4, "command": "preview", "response": "x"}',
+            '{"response": "y", "answer": "x"}',
+        ]
+        expected = [
+            {"id": 1, "result": evaluation_function("2 km/h", "2*kilo*metre/hour", {"strict_syntax": False})},
+            {"error": "Expecting value: line 1 column 1 (char 0)"},
+            {"id": 3, "error": "No answer was given."},
+            {"id": 4, "result": {"preview": {"latex": "~\\mathrm{x}", "sympy": "x"}}},
+            {"result": evaluation_function("y", "x", {})},
+        ]
+        for workers in [1, 2]:
+            with self.subTest(workers=workers):
+                output = [json.loads(line) for line in grade_lines(lines, workers=workers, mode="threads", in_flight=2)]
+                self.assertEqual(output, expected)
+
+    def test_grading_server(self):
+        def post(port, path, body, headers={}):
+            request = urllib.request.Request(f"http://127.0.0.1:{port}{path}", data=json.dumps(body).encode(), headers=headers, method="POST")
+            try:
+                with urllib.request.urlopen(request) as response:
+                    return response.status, json.loads(response.read())
+            except urllib.error.HTTPError as e:
+                return e.code, json.loads(e.read())
+
+        async def run_requests():
+            server = GradingServer(port=0, executor=ThreadPoolExecutor(max_workers=2))
+            await server.start()
+            loop = asyncio.get_running_loop()
+            try:
+                return await asyncio.gather(
+                    loop.run_in_executor(None, post, server.port, "/eval", {"response": "2 km/h", "answer": "2*kilo*metre/hour", "params": {"strict_syntax": False}}),
+                    loop.run_in_executor(None, post, server.port, "/", {"response": "x"}, {"command": "preview"}),
+                    loop.run_in_executor(None, post, server.port, "/eval", {"response": "x", "answer": ""}),
+                    loop.run_in_executor(None, post, server.port, "/grade", {}),
+                    loop.run_in_executor(None, post, server.port, "/eval?"+100000*"x", {"response": "x", "answer": "x"}),
+                )
+            finally:
+                await server.close()
+
+        responses = asyncio.run(run_requests())
+        self.assertEqual(responses[0], (200, {"command": "eval", "result": evaluation_function("2 km/h", "2*kilo*metre/hour", {"strict_syntax": False})}))
+        self.assertEqual(responses[1], (200, {"command": "preview", "result": {"preview": {"latex": "~\\mathrm{x}", "sympy": "x"}}}))
+        self.assertEqual(responses[2], (500, {"error": {"message": "No answer was given."}}))
+        self.assertEqual(responses[3][0], 404)
+        self.assertEqual(responses[4], (431, {"error": {"message": "Request line or header is too long."}}))
+
+
+class TestResultCache(unittest.TestCase):
+    """
+    Tests of the persistent result cache.
+    """
+
+    def test_result_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            configure_result_cache(os.path.join(directory, "results.db"))
+            try:
+                cache = get_result_cache()
+                params = {"strict_syntax": False}
+                result = evaluation_function("2 km/h", "2*kilo*metre/hour", params)
+                self.assertEqual(len(cache), 1)
+                self.assertEqual(cache.get(result_cache_key(" 2 km/h ", "2*kilo*metre/hour", params)), result)
+                # Cache hits only update the time of last use if it is old
+                last_used = lambda: cache._connection().execute("SELECT last_used FROM results").fetchone()[0]
+                cache._connection().execute("UPDATE results SET last_used = 1")
+                cache.get(result_cache_key("2 km/h", "2*kilo*metre/hour", params))
+                updated = last_used()
+                self.assertGreater(updated, 1)
+                cache.get(result_cache_key("2 km/h", "2*kilo*metre/hour", params))
+                self.assertEqual(last_used(), updated)
+                self.assertEqual(evaluation_function("2 km/h", "2*kilo*metre/hour", params), result)
+                self.assertEqual(len(cache), 1)
+                evaluation_function("2 km/h", "2*kilo*metre/hour", {"strict_syntax": False, "timings": True})
+                evaluation_function("2 km/h", "2*kilo*metre/hour", {"strict_syntax": False, "generate_response_latex": "lazy"})
+                self.assertEqual(len(cache), 1)
+                evaluation_function("3 km/h", "2*kilo*metre/hour", params)
+                self.assertEqual(len(cache), 2)
+                # Feedback for responses that cannot be parsed quotes the response, so it is not cached
+                custom_params = {"strict_syntax": False, "custom_feedback": {"PARSE_ERROR_WARNING": "Could not parse."}}
+                for response in ["x+", "(x"]:
+                    self.assertEqual(evaluation_function(response, "x", custom_params), {"is_correct": False, "feedback": "Could not parse."})
+                    self.assertEqual(evaluation_function(response, "x", params), {"is_correct": False, "feedback": parse_error_warning(response)})
+                self.assertEqual(len(cache), 2)
+                small_cache = ResultCache(os.path.join(directory, "small.db"), max_size=1000)
+                for k in range(20):
+                    small_cache.put(result_cache_key(str(k), "x", {}), {"is_correct": False, "feedback": 50*"x"})
+                small_cache.evict()
+                self.assertLessEqual(small_cache.size(), 900)
+                self.assertEqual(small_cache.get(result_cache_key("19", "x", {})), {"is_correct": False, "feedback": 50*"x"})
+                self.assertEqual(small_cache.get(result_cache_key("0", "x", {})), None)
+                # Insertions from several threads are all counted
+                shared_cache = ResultCache(os.path.join(directory, "shared.db"))
+                with ThreadPoolExecutor(max_workers=8) as executor:
+                    list(executor.map(lambda k: shared_cache.put(result_cache_key(str(k), "x", {}), {"is_correct": True}), range(200)))
+                self.assertEqual(len(shared_cache), 200)
+                self.assertEqual(shared_cache._insertions, 200)
+            finally:
+                configure_result_cache(None)
+
+
+if __name__ == "__main__":
+    unittest.main()